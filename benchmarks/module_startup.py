@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Times how long the slony_* modules take to start up and fail fast.
+#
+# Each module is run through `ansible localhost -c local -m <module>` against
+# a port nothing listens on, so a run measures the payload build and transfer,
+# module import time and the first failed connection, and nothing else. Run it
+# before and after a change to see whether startup got slower.
+#
+# Usage: module_startup.py [--runs N] [--max-ms MS] [module ...]
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Module arguments that pass validation but can't reach a database
+UNREACHABLE = "port=1 password=x"
+MODULE_ARGS = {
+    "slony_cluster":      "host=127.0.0.1 db=bench",
+    "slony_node":         "master_host=127.0.0.1 master_db=bench slave_host=127.0.0.1 slave_db=bench node_id=2 event_node_id=1",
+    "slony_path":         "master_host=127.0.0.1 master_db=bench slave_host=127.0.0.1 slave_db=bench server_id=1 client_id=2",
+    "slony_set":          "host=127.0.0.1 db=bench set_id=1 origin_id=1",
+    "slony_table":        "master_host=127.0.0.1 master_db=bench slave_host=127.0.0.1 slave_db=bench set_id=1 origin_id=1 receiver_id=2 tables=[]",
+    "slony_subscription": "master_host=127.0.0.1 master_db=bench slave_host=127.0.0.1 slave_db=bench set_id=1 provider_id=1 receiver_id=2",
+    "slony_maintenance":  "host=127.0.0.1 db=bench",
+    "slony_audit":        "nodes=[]",
+    "slony_slon":         "host=127.0.0.1 db=bench node_id=1 dest=/tmp/slony_startup_bench.conf",
+    "slony_archive":      "host=127.0.0.1 db=bench archive_dir=/tmp/slony_startup_bench",
+    "slony_clone":        "origin_host=127.0.0.1 origin_db=bench master_host=127.0.0.1 master_db=bench slave_host=127.0.0.1 slave_db=bench origin_id=1 provider_id=1 clone_id=3 copy_command=true",
+    "slony_verify":       "master_host=127.0.0.1 master_db=bench slave_host=127.0.0.1 slave_db=bench set_id=1 origin_id=1",
+    "slony_advisor":      "host=127.0.0.1 db=bench set_id=1 set_count=2",
+}
+
+
+def run_once(module, args):
+    env = dict(os.environ)
+    env["ANSIBLE_LIBRARY"] = REPO
+    env["ANSIBLE_MODULE_UTILS"] = os.path.join(REPO, "module_utils")
+    env["ANSIBLE_HOST_KEY_CHECKING"] = "False"
+    cmd = ["ansible", "localhost", "-c", "local", "-m", module, "-a", "%s %s" % (args, UNREACHABLE)]
+    start = time.time()
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = process.communicate()
+    elapsed = (time.time() - start) * 1000
+    # a missing import shows up as a module failure too, make sure the run
+    # actually got as far as trying to connect
+    output = out.decode("utf-8", "replace")
+    if "MODULE FAILURE" in output or "No module named" in output:
+        sys.stderr.write(output)
+        raise SystemExit("%s failed to start" % module)
+    return elapsed
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time of the slony_* modules")
+    parser.add_argument("modules", nargs="*", default=sorted(MODULE_ARGS),
+                        help="modules to time (default: all of them)")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="runs per module (default: %(default)s)")
+    parser.add_argument("--max-ms", type=float, default=None,
+                        help="exit non-zero when any module's median is above this")
+    args = parser.parse_args()
+
+    slow = []
+    print("%-20s %10s %10s" % ("module", "median ms", "p90 ms"))
+    for module in args.modules:
+        if module not in MODULE_ARGS:
+            raise SystemExit("no benchmark arguments for %s" % module)
+        # the first run pays for ansible's own caches, leave it out
+        run_once(module, MODULE_ARGS[module])
+        samples = [run_once(module, MODULE_ARGS[module]) for i in range(args.runs)]
+        median = percentile(samples, 0.5)
+        print("%-20s %10.0f %10.0f" % (module, median, percentile(samples, 0.9)))
+        if args.max_ms is not None and median > args.max_ms:
+            slow.append(module)
+
+    if slow:
+        raise SystemExit("median startup above %sms: %s" % (args.max_ms, ", ".join(slow)))
+
+
+if __name__ == "__main__":
+    main()
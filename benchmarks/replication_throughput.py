@@ -0,0 +1,437 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Measures how many writes per second a two node cluster built by the slony_*
+# modules keeps up with.
+#
+# Creates two throwaway PostgreSQL instances under --workdir, sets up the
+# origin (node 1) and the subscriber (node 2) with slony_cluster, slony_node,
+# slony_path, slony_slon, slony_set, slony_table and slony_subscription
+# through ansible-playbook, starts a slon for each node and runs a write
+# workload against the origin. Every --interval seconds it records the
+# writes done on the origin, the rows applied on the subscriber (from
+# pg_stat_user_tables) and the subscriber's lag in sl_status, and writes
+# them out as CSV. Once the workload stops, sampling goes on until the
+# subscriber has caught up or --drain seconds have passed.
+#
+# Both instances listen only on a Unix socket, each in its own directory, so
+# they can share the one port the modules take.
+#
+# Needs initdb, pg_ctl, psql, slon, slonik, ansible-playbook and psycopg2 on
+# the machine it runs on.
+#
+# Usage: replication_throughput.py [--tables N] [--row-width BYTES]
+#            [--update-ratio R] [--clients N] [--rate ROWS_PER_S]
+#            [--duration S] [--csv FILE] [--slon-option NAME=VALUE ...]
+
+import argparse
+import csv
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psycopg2
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLUSTER = "bench"
+DB = "bench"
+USER = "postgres"
+NODES = (1, 2)
+
+
+def pg_bin(args, name):
+    if args.pg_bin:
+        return os.path.join(args.pg_bin, name)
+    return name
+
+
+def run(cmd, **kw):
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kw)
+    (out, err) = process.communicate()
+    if process.returncode != 0:
+        sys.stderr.write(out.decode("utf-8", "replace"))
+        raise SystemExit("%s failed with exit code %s" % (" ".join(cmd), process.returncode))
+    return out
+
+
+def conninfo(args, node_id):
+    return "host=%s dbname=%s user=%s port=%s" % (socket_dir(args, node_id), DB, USER, args.port)
+
+
+def socket_dir(args, node_id):
+    return os.path.join(args.workdir, "node%s" % node_id)
+
+
+# ===========================================
+# PostgreSQL instances.
+#
+
+def start_instance(args, node_id):
+    datadir = os.path.join(socket_dir(args, node_id), "data")
+    run([pg_bin(args, "initdb"), "-D", datadir, "-U", USER, "--auth=trust", "-E", "UTF8"])
+    conf = open(os.path.join(datadir, "postgresql.conf"), "a")
+    try:
+        conf.write("listen_addresses = ''\n")
+        conf.write("unix_socket_directories = '%s'\n" % socket_dir(args, node_id))
+        conf.write("port = %s\n" % args.port)
+        conf.write("fsync = %s\n" % ("on" if args.fsync else "off"))
+        conf.write("synchronous_commit = %s\n" % ("on" if args.fsync else "off"))
+    finally:
+        conf.close()
+    run([pg_bin(args, "pg_ctl"), "-D", datadir, "-w", "-l", os.path.join(socket_dir(args, node_id), "postgresql.log"), "start"])
+    run([pg_bin(args, "psql"), "-X", "-q", "-h", socket_dir(args, node_id), "-p", str(args.port),
+         "-U", USER, "-d", "postgres", "-c", "CREATE DATABASE %s" % DB])
+
+
+def stop_instance(args, node_id):
+    datadir = os.path.join(socket_dir(args, node_id), "data")
+    if os.path.isdir(datadir):
+        subprocess.call([pg_bin(args, "pg_ctl"), "-D", datadir, "-m", "fast", "-w", "stop"],
+                        stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+
+
+# Slony needs the replicated tables to exist on every node beforehand
+def create_tables(args, node_id):
+    connection = psycopg2.connect(conninfo(args, node_id))
+    connection.autocommit = True
+    cursor = connection.cursor()
+    for i in range(args.tables):
+        cursor.execute("""CREATE TABLE bench_%d (
+                            id bigserial PRIMARY KEY,
+                            payload text NOT NULL,
+                            updated_at timestamptz NOT NULL DEFAULT now())""" % i)
+    connection.close()
+
+
+# ===========================================
+# Cluster setup through the modules.
+#
+
+def module_args(args, **kw):
+    params = {"cluster_name": CLUSTER, "replication_user": USER, "port": str(args.port)}
+    params.update(kw)
+    return params
+
+
+def pair_args(args, **kw):
+    return module_args(args,
+                       master_host=socket_dir(args, 1), master_db=DB,
+                       slave_host=socket_dir(args, 2), slave_db=DB, **kw)
+
+
+def playbook(name, tasks):
+    return [{"name": name, "hosts": "localhost", "connection": "local", "gather_facts": False,
+             "tasks": [{"name": task_name, module: params} for (task_name, module, params) in tasks]}]
+
+
+def run_playbook(args, name, tasks):
+    # JSON is valid YAML, so the playbook doesn't need a YAML library
+    path = os.path.join(args.workdir, "%s.yml" % name.replace(" ", "_"))
+    f = open(path, "w")
+    try:
+        json.dump(playbook(name, tasks), f, indent=2)
+    finally:
+        f.close()
+    env = dict(os.environ)
+    env["ANSIBLE_LIBRARY"] = REPO
+    env["ANSIBLE_MODULE_UTILS"] = os.path.join(REPO, "module_utils")
+    run(["ansible-playbook", "-i", "localhost,", path], env=env)
+
+
+def setup_nodes(args):
+    slon_settings = dict(option.split("=", 1) for option in args.slon_option)
+    tasks = [
+        ("init cluster", "slony_cluster", module_args(args, host=socket_dir(args, 1), db=DB, origin_id=1)),
+        ("store subscriber node", "slony_node", pair_args(args, node_id=2, event_node_id=1)),
+        ("store paths", "slony_path", pair_args(args, server_id=1, client_id=2)),
+    ]
+    for node_id in NODES:
+        params = module_args(args, host=socket_dir(args, node_id), db=DB, node_id=node_id,
+                             dest=os.path.join(args.workdir, "slon%s.conf" % node_id))
+        params.update(slon_settings)
+        tasks.append(("slon config for node %s" % node_id, "slony_slon", params))
+    run_playbook(args, "bench nodes", tasks)
+
+
+def setup_replication(args):
+    tables = [{"id": i + 1, "fqname": "public.bench_%d" % i} for i in range(args.tables)]
+    run_playbook(args, "bench replication", [
+        ("create set", "slony_set", module_args(args, host=socket_dir(args, 1), db=DB, set_id=1, origin_id=1)),
+        ("add tables", "slony_table", pair_args(args, set_id=1, origin_id=1, receiver_id=2, tables=tables, sequences=[])),
+        ("subscribe", "slony_subscription", pair_args(args, set_id=1, provider_id=1, receiver_id=2)),
+    ])
+
+
+def start_slons(args):
+    slons = []
+    for node_id in NODES:
+        log = open(os.path.join(args.workdir, "slon%s.log" % node_id), "a")
+        slons.append(subprocess.Popen([args.slon, "-f", os.path.join(args.workdir, "slon%s.conf" % node_id)],
+                                      stdout=log, stderr=subprocess.STDOUT))
+    return slons
+
+
+def wait_for_subscription(args, timeout):
+    connection = psycopg2.connect(conninfo(args, 2))
+    connection.autocommit = True
+    cursor = connection.cursor()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        cursor.execute("SELECT sub_active FROM _%s.sl_subscribe WHERE sub_set = 1 AND sub_receiver = 2" % CLUSTER)
+        row = cursor.fetchone()
+        if row is not None and row[0]:
+            connection.close()
+            return
+        time.sleep(1)
+    raise SystemExit("node 2 didn't finish subscribing within %ss, see the slon logs in %s" % (timeout, args.workdir))
+
+
+# ===========================================
+# Workload and sampling.
+#
+
+class Workload(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.payload = "x" * args.row_width
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # highest id inserted per table, what updates pick their rows from
+        self.max_ids = [0] * args.tables
+
+    def client(self):
+        args = self.args
+        connection = psycopg2.connect(conninfo(args, 1))
+        cursor = connection.cursor()
+        # each client gets an equal share of the target rate
+        interval = 0
+        if args.rate > 0:
+            interval = float(args.batch * args.clients) / args.rate
+        next_batch = time.time()
+        while not self.stopping.is_set():
+            for i in range(args.batch):
+                table = random.randrange(args.tables)
+                top = self.max_ids[table]
+                if top > 0 and random.random() < args.update_ratio:
+                    cursor.execute("UPDATE bench_%d SET payload = %%s, updated_at = now() WHERE id = %%s" % table,
+                                   (self.payload, random.randint(1, top)))
+                else:
+                    cursor.execute("INSERT INTO bench_%d (payload) VALUES (%%s) RETURNING id" % table, (self.payload,))
+                    inserted = cursor.fetchone()[0]
+                    with self.lock:
+                        self.max_ids[table] = max(self.max_ids[table], inserted)
+            connection.commit()
+            with self.lock:
+                self.writes += args.batch
+            if interval:
+                next_batch += interval
+                delay = next_batch - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        connection.close()
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.client) for i in range(self.args.clients)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+
+class Sampler(object):
+
+    def __init__(self, args):
+        self.origin = psycopg2.connect(conninfo(args, 1))
+        self.origin.autocommit = True
+        self.subscriber = psycopg2.connect(conninfo(args, 2))
+        self.subscriber.autocommit = True
+
+    def lag(self):
+        cursor = self.origin.cursor()
+        cursor.execute("""SELECT st_lag_num_events, extract(epoch FROM st_lag_time)
+                          FROM _%s.sl_status WHERE st_received = 2""" % CLUSTER)
+        row = cursor.fetchone()
+        if row is None:
+            return (None, None)
+        return (row[0], float(row[1]))
+
+    # The log trigger is disabled on a subscriber, but the applied rows
+    # still count as ordinary inserts and updates there
+    def applied_rows(self):
+        cursor = self.subscriber.cursor()
+        cursor.execute("""SELECT coalesce(sum(n_tup_ins + n_tup_upd), 0)
+                          FROM pg_catalog.pg_stat_user_tables
+                          WHERE schemaname = 'public' AND relname LIKE 'bench\\_%'""")
+        return int(cursor.fetchone()[0])
+
+    def close(self):
+        self.origin.close()
+        self.subscriber.close()
+
+
+def measure(args, workload, sampler, writer):
+    start = time.time()
+    baseline = sampler.applied_rows()
+    last = (start, 0, 0)
+    samples = []
+    workload.start()
+    phase = "load"
+    drain_until = None
+    while True:
+        time.sleep(args.interval)
+        now = time.time()
+        if phase == "load" and now - start >= args.duration:
+            workload.stop()
+            phase = "drain"
+            drain_until = now + args.drain
+        (lag_events, lag_seconds) = sampler.lag()
+        writes = workload.writes
+        applied = sampler.applied_rows() - baseline
+        elapsed = now - last[0]
+        sample = {
+            "elapsed_s": round(now - start, 1),
+            "phase": phase,
+            "writes": writes,
+            "writes_per_s": round((writes - last[1]) / elapsed, 1),
+            "applied_rows": applied,
+            "applied_rows_per_s": round((applied - last[2]) / elapsed, 1),
+            "lag_events": lag_events,
+            "lag_seconds": lag_seconds,
+        }
+        writer.writerow(sample)
+        samples.append(sample)
+        last = (now, writes, applied)
+        if phase == "drain" and ((applied >= writes and lag_events is not None and lag_events <= 1)
+                                 or now >= drain_until):
+            return samples
+
+
+def summarize(args, samples):
+    load = [s for s in samples if s["phase"] == "load"]
+    drain = [s for s in samples if s["phase"] == "drain"]
+    if not load:
+        return
+    duration = load[-1]["elapsed_s"]
+    sys.stderr.write("writes/s on origin:        %.0f\n" % (load[-1]["writes"] / duration))
+    sys.stderr.write("applied rows/s under load: %.0f\n" % (load[-1]["applied_rows"] / duration))
+    lags = [s["lag_seconds"] for s in samples if s["lag_seconds"] is not None]
+    if lags:
+        sys.stderr.write("max lag:                   %.1fs\n" % max(lags))
+    if drain:
+        caught_up = drain[-1]["applied_rows"] >= drain[-1]["writes"]
+        sys.stderr.write("drain:                     %.1fs%s\n"
+                         % (drain[-1]["elapsed_s"] - duration, "" if caught_up else " (still behind)"))
+
+
+# ===========================================
+# Entry point.
+#
+
+def main():
+    parser = argparse.ArgumentParser(description="Replication throughput of a two node cluster built by the slony_* modules")
+    parser.add_argument("--workdir", default=None,
+                        help="where to put the instances, configs and logs (default: a new temporary directory)")
+    parser.add_argument("--keep", action="store_true",
+                        help="leave the instances and workdir behind afterwards")
+    parser.add_argument("--port", type=int, default=54329,
+                        help="port both instances use, on their own socket directories (default: %(default)s)")
+    parser.add_argument("--pg-bin", default=None,
+                        help="directory holding initdb, pg_ctl and psql (default: from PATH)")
+    parser.add_argument("--slon", default="slon",
+                        help="slon binary (default: %(default)s)")
+    parser.add_argument("--fsync", action="store_true",
+                        help="keep fsync and synchronous_commit on in both instances")
+    parser.add_argument("--slon-option", action="append", default=[], metavar="NAME=VALUE",
+                        help="slony_slon setting for both slons, may be repeated, e.g. sync_group_maxsize=100")
+    parser.add_argument("--tables", type=int, default=4,
+                        help="number of replicated tables (default: %(default)s)")
+    parser.add_argument("--row-width", type=int, default=100,
+                        help="payload bytes per row (default: %(default)s)")
+    parser.add_argument("--update-ratio", type=float, default=0.5,
+                        help="fraction of writes that update an existing row (default: %(default)s)")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="concurrent writers on the origin (default: %(default)s)")
+    parser.add_argument("--batch", type=int, default=10,
+                        help="writes per transaction (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="target writes per second across all clients, 0 for as fast as possible (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="seconds to run the workload for (default: %(default)s)")
+    parser.add_argument("--drain", type=float, default=120,
+                        help="seconds to keep sampling afterwards while the subscriber catches up (default: %(default)s)")
+    parser.add_argument("--interval", type=float, default=1,
+                        help="seconds between samples (default: %(default)s)")
+    parser.add_argument("--subscribe-timeout", type=float, default=300,
+                        help="seconds to wait for the initial subscription (default: %(default)s)")
+    parser.add_argument("--csv", default="-",
+                        help="where to write the samples (default: stdout)")
+    args = parser.parse_args()
+
+    if args.tables < 1 or args.clients < 1 or args.batch < 1:
+        raise SystemExit("--tables, --clients and --batch must be at least 1")
+    for option in args.slon_option:
+        if "=" not in option:
+            raise SystemExit("--slon-option takes NAME=VALUE, got %s" % option)
+
+    created_workdir = args.workdir is None
+    if created_workdir:
+        args.workdir = tempfile.mkdtemp(prefix="slony_bench_")
+    args.workdir = os.path.abspath(args.workdir)
+
+    if args.csv == "-":
+        output = sys.stdout
+    else:
+        output = open(args.csv, "w")
+    writer = csv.DictWriter(output, ["elapsed_s", "phase", "writes", "writes_per_s",
+                                     "applied_rows", "applied_rows_per_s", "lag_events", "lag_seconds"])
+
+    slons = []
+    try:
+        for node_id in NODES:
+            os.makedirs(socket_dir(args, node_id))
+            start_instance(args, node_id)
+            create_tables(args, node_id)
+
+        setup_nodes(args)
+        slons = start_slons(args)
+        setup_replication(args)
+        wait_for_subscription(args, args.subscribe_timeout)
+
+        writer.writeheader()
+        sampler = Sampler(args)
+        try:
+            samples = measure(args, Workload(args), sampler, writer)
+        finally:
+            sampler.close()
+        output.flush()
+        summarize(args, samples)
+    finally:
+        for slon in slons:
+            slon.terminate()
+            slon.wait()
+        if not args.keep:
+            for node_id in NODES:
+                stop_instance(args, node_id)
+            if created_workdir:
+                shutil.rmtree(args.workdir, ignore_errors=True)
+        else:
+            sys.stderr.write("instances and logs left in %s\n" % args.workdir)
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Long-lived helper for the slony_* modules on the control host.
+#
+# Every slony_* task is a fresh process that opens its own connections to
+# each node it touches. When this agent is running, the modules hand their
+# catalog queries and slonik runs to it over a Unix socket instead and it
+# serves them off a pool of open connections, plus a short lived cache for
+# the few reads the modules mark as cacheable. Everything else is read live,
+# as slon, psql and slonik runs that don't go through the agent change the
+# catalog without it knowing. Modules fall back to connecting directly when
+# the socket isn't there.
+#
+# Protocol: one JSON object per line in each direction.
+#
+#   {"op": "ping"}
+#   {"op": "query", "conninfo": "...", "sql": "...", "args": [...], "cache": false}
+#       -> {"columns": [...], "rows": [[...], ...], "rowcount": n}
+#   {"op": "slonik", "script": "slonik <<_EOF_ ..."}
+#       -> {"rc": n, "out": "...", "err": "..."}
+#   {"op": "release", "conninfo": "..."}
+#       -> {"released": true}
+#
+# Failures come back as {"error": "..."}.
+#
+# Each client gets its own connection per conninfo for as long as it stays
+# connected, so session state such as advisory locks behaves the way it would
+# on a direct connection. When the client goes away the connection is rolled
+# back, its advisory locks released and it goes back into the pool. A
+# client can also release a connection early, which closes it outright so
+# nothing keeps that database open.
+#
+# Usage: slony_agent.py [--socket PATH] [--cache-ttl SECONDS] [--max-idle N]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+import psycopg2
+
+DEFAULT_SOCKET = "~/.ansible/slony_agent.sock"
+
+
+class ConnectionPool(object):
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def checkout(self, conninfo):
+        with self.lock:
+            idle = self.idle.get(conninfo, [])
+            while idle:
+                connection = idle.pop()
+                if not connection.closed:
+                    return connection
+        connection = psycopg2.connect(conninfo)
+        connection.set_isolation_level(0)
+        return connection
+
+    def checkin(self, conninfo, connection):
+        if connection.closed:
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT pg_catalog.pg_advisory_unlock_all()")
+            cursor.close()
+        except psycopg2.Error:
+            connection.close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(conninfo, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+
+class CatalogCache(object):
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def key(self, request):
+        return (request["conninfo"], request["sql"], json.dumps(request.get("args")))
+
+    def get(self, request):
+        with self.lock:
+            entry = self.entries.get(self.key(request))
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def put(self, request, reply):
+        with self.lock:
+            self.entries[self.key(request)] = (time.time() + self.ttl, reply)
+
+    # Any slonik run may change the catalog on any node
+    def flush(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class AgentHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.connections = {}
+        try:
+            for line in iter(self.rfile.readline, b""):
+                try:
+                    reply = self.dispatch(json.loads(line.decode("utf-8")))
+                except Exception as e:
+                    reply = {"error": str(e)}
+                self.wfile.write((json.dumps(reply, default=str) + "\n").encode("utf-8"))
+                self.wfile.flush()
+        finally:
+            for (conninfo, connection) in self.connections.items():
+                self.server.pool.checkin(conninfo, connection)
+
+    def dispatch(self, request):
+        op = request.get("op")
+        if op == "ping":
+            return {"pong": True}
+        if op == "query":
+            return self.query(request)
+        if op == "slonik":
+            return self.slonik(request)
+        if op == "release":
+            return self.release(request)
+        raise ValueError("unknown op %r" % op)
+
+    def query(self, request):
+        cache = self.server.cache
+        if request.get("cache"):
+            reply = cache.get(request)
+            if reply is not None:
+                return reply
+
+        conninfo = request["conninfo"]
+        if conninfo not in self.connections:
+            self.connections[conninfo] = self.server.pool.checkout(conninfo)
+        cursor = self.connections[conninfo].cursor()
+        try:
+            cursor.execute(request["sql"], request.get("args"))
+            if cursor.description is None:
+                reply = {"columns": [], "rows": [], "rowcount": cursor.rowcount}
+            else:
+                reply = {"columns": [c[0] for c in cursor.description],
+                         "rows": [list(r) for r in cursor.fetchall()],
+                         "rowcount": cursor.rowcount}
+        finally:
+            cursor.close()
+
+        if request.get("cache"):
+            # round trip through json now, so cached and fresh replies look
+            # exactly the same to the client
+            reply = json.loads(json.dumps(reply, default=str))
+            cache.put(request, reply)
+        return reply
+
+    def release(self, request):
+        connection = self.connections.pop(request["conninfo"], None)
+        if connection is not None:
+            connection.close()
+        return {"released": connection is not None}
+
+    def slonik(self, request):
+        self.server.cache.flush()
+        try:
+            process = subprocess.Popen(request["script"], shell=True,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (out, err) = process.communicate()
+        finally:
+            self.server.cache.flush()
+        return {"rc": process.returncode,
+                "out": out.decode("utf-8", "replace"),
+                "err": err.decode("utf-8", "replace")}
+
+
+class AgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connection pooling agent for the slony_* Ansible modules")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET,
+                        help="Unix socket to listen on (default: %(default)s)")
+    parser.add_argument("--cache-ttl", type=float, default=5.0,
+                        help="seconds to cache slony catalog reads for, 0 disables the cache (default: %(default)s)")
+    parser.add_argument("--max-idle", type=int, default=4,
+                        help="idle connections kept per conninfo (default: %(default)s)")
+    args = parser.parse_args()
+
+    path = os.path.expanduser(args.socket)
+    if os.path.exists(path):
+        os.unlink(path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    # the socket hands out database sessions, keep it to ourselves
+    old_umask = os.umask(0o077)
+    try:
+        server = AgentServer(path, AgentHandler)
+    finally:
+        os.umask(old_umask)
+    server.pool = ConnectionPool(args.max_idle)
+    server.cache = CatalogCache(args.cache_ttl)
+
+    sys.stderr.write("slony_agent listening on %s\n" % path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+# Shared code for the slony_* modules. Point Ansible at the parent directory
+# (module_utils = ./module_utils in ansible.cfg, or ANSIBLE_MODULE_UTILS) and
+# each module only ships the parts of this package it imports.
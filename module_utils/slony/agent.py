@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# slony_agent client. When contrib/slony_agent.py is running on this host,
+# catalog queries and slonik runs go through it and reuse its pooled
+# connections; otherwise the module connects and runs slonik itself.
+#
+
+import json
+import os
+import socket
+
+DEFAULT_SOCKET = "~/.ansible/slony_agent.sock"
+
+# Seconds to wait on the agent. An agent that doesn't answer a ping quickly
+# is treated as not running. slonik runs get no timeout, as waiting for
+# events or a copy legitimately takes as long as it takes.
+PING_TIMEOUT = 5
+QUERY_TIMEOUT = 300
+
+class AgentError(Exception):
+    pass
+
+class Agent(object):
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(PING_TIMEOUT)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('r')
+
+    def request(self, timeout=QUERY_TIMEOUT, **request):
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.sendall(json.dumps(request) + "\n")
+            line = self.rfile.readline()
+        except socket.timeout:
+            raise AgentError("no reply from slony_agent within %ss" % timeout)
+        if not line:
+            raise AgentError("slony_agent closed the connection")
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise AgentError(reply['error'])
+        return reply
+
+    def connection(self, conninfo):
+        connection = AgentConnection(self, conninfo)
+        # fail here rather than on the first query, like psycopg2.connect would
+        connection.cursor().execute("SELECT 1")
+        return connection
+
+# Supports both index and column name access like a DictCursor row
+class AgentRow(list):
+    def __init__(self, columns, values):
+        list.__init__(self, values)
+        self.columns = columns
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self.columns.index(key)
+        return list.__getitem__(self, key)
+
+# Agent connections are always in autocommit mode, so transaction control
+# is a no-op
+class AgentConnection(object):
+    def __init__(self, agent, conninfo):
+        self.agent = agent
+        self.conninfo = conninfo
+
+    def cursor(self, cursor_factory=None):
+        return AgentCursor(self)
+
+    def set_isolation_level(self, level):
+        pass
+
+    def commit(self):
+        pass
+
+    # hands the pooled connection back, so nothing holds the database open
+    def close(self):
+        self.agent.request(op="release", conninfo=self.conninfo)
+
+class AgentCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self.rows = []
+
+    # Only reads that can't go stale in a way that matters may pass cache,
+    # the agent can't tell when slon, psql or another slonik changed the
+    # catalog behind its back
+    def execute(self, query, args=None, cache=False):
+        reply = self.connection.agent.request(op="query", conninfo=self.connection.conninfo,
+                                              sql=query, args=args, cache=cache)
+        self.rowcount = reply['rowcount']
+        self.rows = [AgentRow(reply['columns'], r) for r in reply['rows']]
+
+    def fetchone(self):
+        if not self.rows:
+            return None
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        (rows, self.rows) = (self.rows, [])
+        return rows
+
+agent = None
+
+def agent_client(module):
+    global agent
+    if agent is None:
+        path = os.path.expanduser(module.params.get("agent_socket") or DEFAULT_SOCKET)
+        try:
+            agent = Agent(path)
+            agent.request(op="ping", timeout=PING_TIMEOUT)
+        except (socket.error, ValueError, AgentError):
+            agent = False
+    return agent or None
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# Connection handling and catalog checks shared by the slony_* modules.
+#
+# psycopg2 is only imported once a module actually opens a connection, and
+# not at all when the slony_agent is serving it.
+#
+
+from ansible.module_utils.slony.agent import AgentConnection, AgentCursor, agent_client
+
+def build_conninfo(host, db, replication_user, port, password):
+    return "host=%s dbname=%s user=%s port=%s password=%s" % (host, db, replication_user, port, password)
+
+# To use defaults values, keyword arguments must be absent, so
+# check which values are empty and don't include in the **kw
+# dictionary
+PARAMS_MAP = {
+    "password":"password",
+    "port":"port"
+}
+
+def connection_kwargs(module):
+    return dict( (PARAMS_MAP[k], v) for (k, v) in module.params.iteritems()
+                 if k in PARAMS_MAP and v != '' )
+
+def require_psycopg2(module):
+    try:
+        import psycopg2
+        import psycopg2.extensions
+        import psycopg2.extras
+    except ImportError:
+        module.fail_json(msg="the python psycopg2 module is required")
+    return psycopg2
+
+# Takes either a conninfo string or psycopg2.connect keyword arguments
+def connect(module, conninfo=None, **kw):
+    client = agent_client(module)
+    if client is not None:
+        if conninfo is None:
+            keys = {'database': 'dbname'}
+            conninfo = " ".join("%s=%s" % (keys.get(k, k), v) for (k, v) in sorted(kw.items()))
+        return client.connection(conninfo)
+
+    psycopg2 = require_psycopg2(module)
+    if conninfo is None:
+        return psycopg2.connect(**kw)
+    return psycopg2.connect(conninfo)
+
+def dict_cursor(connection):
+    if isinstance(connection, AgentConnection):
+        return connection.cursor()
+    import psycopg2.extras
+    return connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+# Lets the agent answer from its cache. Only for reads whose answer doesn't
+# change under a running playbook, anything slon, psql or cleanup touches
+# has to be read live.
+def execute_cached(cursor, query, args=None):
+    if isinstance(cursor, AgentCursor):
+        return cursor.execute(query, args, cache=True)
+    return cursor.execute(query, args)
+
+def schema_exists(cursor, cluster_name):
+    query = "SELECT * FROM pg_catalog.pg_namespace WHERE nspname=%(schema)s"
+    execute_cached(cursor, query, {'schema': "_" + cluster_name})
+    return cursor.rowcount == 1
+
+def set_origin(cursor, cluster_name, set_id):
+    query = "SELECT set_origin FROM _{0}.sl_set WHERE set_id = %s".format(cluster_name)
+    cursor.execute(query, (int(set_id),))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+# Tables of the set in id order, as rows addressable by column name
+def replicated_tables(cursor, cluster_name, set_id):
+    query = """SELECT tab_id,tab_relname,tab_nspname,tab_set,tab_idxname,tab_comment
+               FROM _{0}.sl_table
+               WHERE tab_set = %s
+               ORDER BY tab_id""".format(cluster_name)
+    cursor.execute(query, (int(set_id),))
+    return cursor.fetchall()
+
+# Sequences of the set in id order, as rows addressable by column name
+def replicated_sequences(cursor, cluster_name, set_id):
+    query = """SELECT seq_id,seq_relname,seq_nspname,seq_set,seq_comment
+               FROM _{0}.sl_sequence
+               WHERE seq_set = %s
+               ORDER BY seq_id""".format(cluster_name)
+    cursor.execute(query, (int(set_id),))
+    return cursor.fetchall()
+
+# Greedy heaviest-first packing: every item goes into whichever of count
+# buckets is lightest so far. Buckets that end up empty are dropped.
+def balance_buckets(items, count, weight):
+    buckets = [[] for i in range(count)]
+    loads = [0.0] * count
+    for item in sorted(items, key=weight, reverse=True):
+        lightest = loads.index(min(loads))
+        buckets[lightest].append(item)
+        loads[lightest] += weight(item)
+    return [b for b in buckets if b]
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Keeping concurrent and disruptive slony_* runs from stepping on each other
+# and on slon: the per-cluster advisory lock and the replication lag gate.
+#
+
+import time
+
+from ansible.module_utils.slony.common import build_conninfo, connect, dict_cursor
+from ansible.module_utils.slony.slonik import jittered
+
+def lowest_node_id(cursor, cluster_name):
+    cursor.execute("SELECT min(no_id) FROM _{0}.sl_node".format(cluster_name))
+    return cursor.fetchone()[0]
+
+# The cluster lock only keeps out tasks that take it on the same database,
+# so every task takes it on the cluster's lowest numbered node, usually the
+# one slony_cluster initialized. nodes lists (node_id, host, db) of the nodes
+# the module has connection details for, the one cursor is connected to
+# first. When none of them is the lock node, lock_host / lock_db have to
+# point at it. The connection has to stay open for as long as the lock is
+# needed, which the returned cursor takes care of.
+def cluster_lock_cursor(module, cursor, cluster_name, nodes):
+    if module.params["lock_host"] or module.params["lock_db"]:
+        host = module.params["lock_host"] or nodes[0][1]
+        db = module.params["lock_db"] or nodes[0][2]
+    else:
+        lock_node_id = lowest_node_id(cursor, cluster_name)
+        known = [(host, db) for (node_id, host, db) in nodes
+                 if node_id is not None and int(node_id) == lock_node_id]
+        if not known:
+            module.fail_json(msg="the lock of cluster %s is taken on node %s, its lowest numbered node, which this task doesn't connect to; "
+                                 "set lock_host and lock_db to that node's database" % (cluster_name, lock_node_id))
+        (host, db) = known[0]
+    if (host, db) == (nodes[0][1], nodes[0][2]):
+        return cursor
+    try:
+        connection = connect(module, build_conninfo(host, db, module.params["replication_user"],
+                                                    module.params["port"], module.params["password"]))
+        connection.set_isolation_level(0)
+    except Exception, e:
+        module.fail_json(msg="unable to connect to the lock node %s/%s: %s" % (host, db, e))
+    return dict_cursor(connection)
+
+# Serializes slony_* runs against the same cluster, so that a check and the
+# slonik run acting on it can't interleave with another task's. The lock is
+# session level and goes away with the connection when the module exits.
+def lock_cluster(module, cursor, cluster_name):
+    deadline = time.time() + module.params["lock_timeout"]
+    delay = 0.5
+    while True:
+        cursor.execute("SELECT pg_catalog.pg_try_advisory_lock(pg_catalog.hashtext(%s))", ("_" + cluster_name,))
+        locked = cursor.fetchone()[0]
+        cursor.connection.commit()
+        if locked:
+            return
+        if time.time() > deadline:
+            module.fail_json(msg="timed out after %ss waiting for the lock on cluster %s" % (module.params["lock_timeout"], cluster_name))
+        time.sleep(jittered(delay))
+        delay = min(delay * 2, 10)
+
+# Lag of the given receivers as seen from the node the cursor is connected
+# to, which should be the origin of the events in question. None means
+# every node in sl_status.
+def lagging_receivers(cursor, cluster_name, receiver_ids, max_events, max_seconds):
+    query = """SELECT st_received, st_lag_num_events,
+                      extract(epoch FROM st_lag_time)::bigint AS st_lag_seconds
+               FROM _{0}.sl_status""".format(cluster_name)
+    if receiver_ids is None:
+        cursor.execute(query)
+    else:
+        cursor.execute(query + " WHERE st_received = ANY(%s)", (map(int, receiver_ids),))
+    rows = cursor.fetchall()
+    # sl_status is computed off now(), which stands still inside a transaction
+    cursor.connection.commit()
+    lagging = []
+    for row in rows:
+        if ((max_events is not None and row['st_lag_num_events'] > max_events) or
+                (max_seconds is not None and row['st_lag_seconds'] > max_seconds)):
+            lagging.append({'node': row['st_received'],
+                            'lag_events': row['st_lag_num_events'],
+                            'lag_seconds': row['st_lag_seconds']})
+    return lagging
+
+# Holds off a disruptive operation until the receivers involved have caught
+# up, backing off between checks. Disabled unless max_lag_events or
+# max_lag_seconds is set.
+def wait_for_lag(module, cursor, cluster_name, receiver_ids):
+    max_events = module.params["max_lag_events"]
+    max_seconds = module.params["max_lag_seconds"]
+    if max_events is None and max_seconds is None:
+        return
+    if receiver_ids is not None and len(receiver_ids) == 0:
+        return
+
+    deadline = time.time() + module.params["lag_timeout"]
+    delay = 1
+    while True:
+        lagging = lagging_receivers(cursor, cluster_name, receiver_ids, max_events, max_seconds)
+        if not lagging:
+            return
+        if time.time() + delay > deadline:
+            module.fail_json(msg="receivers are still lagging after %ss, refusing to add more events" % module.params["lag_timeout"],
+                             lagging=lagging)
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
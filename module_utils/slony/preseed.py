@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# Checks that a receiver restored from a backup holds the same tables as its
+# provider, before a subscription with omit copy tells slony to trust it.
+#
+# A node only gets sl_table rows for a set of another origin once it
+# subscribes to it, so the receiver's side is read from pg_class by name.
+#
+
+# Row estimates for every table of the set, keyed by (schema, table)
+def set_table_estimates(cursor, cluster_name, set_id):
+    query = """SELECT t.tab_nspname, t.tab_relname, c.reltuples::bigint
+               FROM _{0}.sl_table t
+               LEFT JOIN pg_catalog.pg_namespace n ON n.nspname = t.tab_nspname
+               LEFT JOIN pg_catalog.pg_class c ON c.relnamespace = n.oid
+                                               AND c.relname = t.tab_relname
+               WHERE t.tab_set = %s""".format(cluster_name)
+    cursor.execute(query, (int(set_id),))
+    return dict( ((r[0], r[1]), r[2]) for r in cursor.fetchall() )
+
+# Row estimates of the named tables, for the ones that exist
+def relation_estimates(cursor, names):
+    names = sorted(names)
+    query = """SELECT n.nspname, c.relname, c.reltuples::bigint
+               FROM unnest(%s::text[], %s::text[]) AS r(nspname, relname)
+               JOIN pg_catalog.pg_namespace n ON n.nspname = r.nspname
+               JOIN pg_catalog.pg_class c ON c.relnamespace = n.oid
+                                          AND c.relname = r.relname
+                                          AND c.relkind = 'r'"""
+    cursor.execute(query, ([n[0] for n in names], [n[1] for n in names]))
+    return dict( ((r[0], r[1]), r[2]) for r in cursor.fetchall() )
+
+# Catch a receiver that was restored from the wrong backup, or from one that
+# is missing tables, before we tell slony to trust its contents
+def verify_preseeded(provider_estimates, receiver_estimates, tolerance):
+    problems = []
+    for (name, provider_rows) in sorted(provider_estimates.items()):
+        fqname = "%s.%s" % name
+        receiver_rows = receiver_estimates.get(name)
+        if provider_rows is None:
+            continue
+        if receiver_rows is None:
+            problems.append("%s is missing on the receiver" % fqname)
+            continue
+        # a freshly restored table reports -1 until it has been analyzed
+        if receiver_rows < 0 and provider_rows >= 0:
+            problems.append("%s has no statistics on the receiver, ANALYZE it first" % fqname)
+            continue
+        allowed = max(provider_rows, receiver_rows) * tolerance / 100.0
+        if abs(provider_rows - receiver_rows) > allowed:
+            problems.append("%s has ~%s rows on the provider but ~%s on the receiver"
+                            % (fqname, provider_rows, receiver_rows))
+    return problems
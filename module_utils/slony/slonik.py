@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Building and running slonik scripts.
+#
+# Every script is the same fixed preamble (cluster name and admin conninfos)
+# followed by a list of statements, so instead of rendering a template per
+# call the statements are joined into one prebuilt format string.
+#
+
+import random
+import re
+import time
+
+SLONIK_SCRIPT = """
+    slonik <<_EOF_
+    cluster name = %s;
+    %s
+_EOF_
+    """
+
+# admin_nodes is a list of (node_id, conninfo)
+def slonik_script(cluster_name, admin_nodes, statements):
+    lines = ["node %s admin conninfo='%s';" % (node_id, conninfo) for (node_id, conninfo) in admin_nodes]
+    return SLONIK_SCRIPT % (cluster_name, "\n    ".join(lines + list(statements)))
+
+def slonik_command(module, cmd):
+    # imported here so that building and classifying scripts works without
+    # ansible, the tests rely on it
+    from ansible.module_utils.slony.agent import agent_client
+    client = agent_client(module)
+    if client is None:
+        return module.run_command(cmd, use_unsafe_shell=True)
+    reply = client.request(op="slonik", script=cmd, timeout=None)
+    return (reply['rc'], reply['out'], reply['err'])
+
+# All patterns below are matched against the error line slonik_error picks,
+# never the whole output, where progress lines like "waiting for event" would
+# match too.
+
+# Failures that go away on their own: another slonik holding sl_config_lock
+# or one of the tables behind it, or a node that is restarting or whose slon
+# hasn't caught up with the events slonik waits on
+TRANSIENT = re.compile(r'sl_config_lock|deadlock detected|could not obtain lock|lock timeout'
+                       r'|could not serialize access'
+                       r'|could not connect to server|server closed the connection unexpectedly'
+                       r'|the database system is (starting up|shutting down)'
+                       r'|not (yet )?ready|has not (yet )?confirmed|not yet confirmed', re.IGNORECASE)
+
+# Failures meaning the statement's work was already done, by an earlier or
+# concurrent run. Which of the two applies depends on the statement, so
+# callers pass one to run_slonik, and only for single statement scripts,
+# where it can't hide a later statement that never ran. Both only match
+# slony's own errors about its catalog, so a missing database or slonik
+# binary stays fatal.
+ALREADY_PRESENT = re.compile(r'Slony-I: .*(already exists|already been assigned|already assigned|is already (a )?(member|subscribed|defined))'
+                             r'|namespace "_\w+" already exists'
+                             r'|duplicate key value violates unique constraint "sl_', re.IGNORECASE)
+ALREADY_ABSENT = re.compile(r'Slony-I: .*(not found|does not exist|unknown (node|set|table|sequence))', re.IGNORECASE)
+
+# slonik prefixes what it reports with the script line it was running
+SCRIPT_LINE = re.compile(r'^<stdin>:(\d+):')
+
+# One of "ok", "done", "transient" or "fatal"
+def classify_slonik(rc, out, err, done=None):
+    if rc == 0:
+        return "ok"
+    error = slonik_error(out, err)
+    if done is not None and done.search(error):
+        return "done"
+    if TRANSIENT.search(error):
+        return "transient"
+    return "fatal"
+
+# slonik prints a line per statement, the interesting one is the error
+def slonik_error(out, err):
+    lines = [l.strip() for l in (err or out or "").splitlines() if l.strip()]
+    for line in lines:
+        if "ERROR" in line or "FATAL" in line:
+            return line
+    for line in lines:
+        if SCRIPT_LINE.match(line):
+            return line
+    if lines:
+        return lines[-1]
+    return "slonik failed without any output"
+
+# Script lines of the statements, leaving out the cluster name and admin
+# conninfo preamble
+def statement_lines(cmd):
+    body = cmd.split("<<_EOF_\n", 1)[-1].split("\n_EOF_", 1)[0]
+    numbers = []
+    for (number, line) in enumerate(body.splitlines()):
+        line = line.strip()
+        if line and not line.startswith("cluster name") and not re.match(r'node \d+ admin conninfo', line):
+            numbers.append(number + 1)
+    return numbers
+
+# Rerunning a whole script is only safe when nothing in it took effect, that
+# is when it has one statement or it failed on its first one
+def retryable(cmd, out, err):
+    numbers = statement_lines(cmd)
+    if len(numbers) <= 1:
+        return True
+    failed = SCRIPT_LINE.match(slonik_error(out, err))
+    return failed is not None and int(failed.group(1)) == numbers[0]
+
+def jittered(delay):
+    return delay + random.uniform(0, delay)
+
+# Runs a slonik script, retrying transient failures up to slonik_retries
+# times with jittered exponential backoff from slonik_retry_delay seconds, as
+# long as the script is retryable. An already-done failure matching done
+# counts as success. Modules without the retry options run the script once.
+def run_slonik(module, cmd, done=None):
+    retries = module.params.get("slonik_retries") or 0
+    delay = module.params.get("slonik_retry_delay") or 1
+    attempt = 0
+    while True:
+        (rc, out, err) = slonik_command(module, cmd)
+        outcome = classify_slonik(rc, out, err, done)
+        if outcome == "done":
+            return (0, out, err)
+        if outcome != "transient" or attempt >= retries or not retryable(cmd, out, err):
+            return (rc, out, err)
+        attempt += 1
+        time.sleep(jittered(delay))
+        delay = min(delay * 2, 30)
+
+# Fails the module with the slonik error line up front and the outcome class
+# alongside the full output
+def fail_slonik(module, rc, out, err, msg=None):
+    outcome = classify_slonik(rc, out, err)
+    error = slonik_error(out, err)
+    if outcome == "transient":
+        error = "%s (transient, retried up to %s times where the script was safe to rerun)" % (error, module.params.get("slonik_retries") or 0)
+    if msg:
+        error = "%s: %s" % (msg, error)
+    module.fail_json(msg=error, rc=rc, stdout=out, stderr=err, outcome=outcome)
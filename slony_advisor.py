@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = '''
+---
+module: slony_advisor
+author: Alexandr Kurilin
+version_added: "1.9"
+short_description: Propose a split of a replication set by write volume and size
+requirements: [psycopg2]
+description:
+    - Reads the write counters in pg_stat_user_tables and
+      pg_total_relation_size for every table of set_id on its origin, and
+      spreads the tables over set_count sets so that each set gets a
+      similar share of the writes and of the data
+    - Write counters count from the last statistics reset. With
+      sample_seconds set they are read twice that far apart instead, and the
+      difference is used, which reflects the current write rate.
+    - write_weight is how much the write share counts against the size share
+      when balancing, from 0 (size only) to 1 (writes only)
+    - The first proposed set keeps set_id along with all of its sequences,
+      the others get ids from first_new_set_id on, by default the first ones
+      not used in sl_set. Nothing is changed.
+    - Each entry of proposal is set_id, origin_id, tables and sequences in
+      the form slony_table takes them, tables with the key they are
+      replicated by, while stats holds the write rate and size behind each
+      one
+'''
+
+EXAMPLES = '''
+- slony_advisor: host=db1 db=app set_id=1 set_count=4 sample_seconds=60
+  register: advice
+
+- slony_set: host=db1 db=app set_id={{ item.set_id }} origin_id={{ item.origin_id }}
+  with_items: advice.proposal
+
+- slony_table:
+    master_host: db1
+    master_db: app
+    slave_host: db2
+    slave_db: app
+    receiver_id: 2
+    set_id: "{{ item.set_id }}"
+    origin_id: "{{ item.origin_id }}"
+    tables: "{{ item.tables }}"
+    sequences: "{{ item.sequences }}"
+  with_items: advice.proposal
+'''
+
+import time
+
+from ansible.module_utils.slony.common import balance_buckets, build_conninfo, connect, dict_cursor, replicated_sequences, schema_exists, set_origin
+
+# ===========================================
+# Postgres / slony support methods.
+#
+
+def next_set_id(cursor, cluster_name):
+    cursor.execute("SELECT coalesce(max(set_id), 0) + 1 FROM _{0}.sl_set".format(cluster_name))
+    return cursor.fetchone()[0]
+
+# Tables of the set with their write counters and size. The counters are only
+# meaningful on the origin, subscribers see the applied rows instead.
+def table_activity(cursor, cluster_name, set_id):
+    query = """SELECT t.tab_id, t.tab_nspname, t.tab_relname, t.tab_idxname, t.tab_comment,
+                      coalesce(s.n_tup_ins + s.n_tup_upd + s.n_tup_del, 0) AS writes,
+                      coalesce(pg_catalog.pg_total_relation_size(t.tab_reloid), 0) AS size
+               FROM _{0}.sl_table t
+               LEFT JOIN pg_catalog.pg_stat_user_tables s ON s.relid = t.tab_reloid
+               WHERE t.tab_set = %s
+               ORDER BY t.tab_id""".format(cluster_name)
+    cursor.execute(query, (int(set_id),))
+    tables = []
+    for row in cursor.fetchall():
+        tables.append({
+            'id': row['tab_id'],
+            'fqname': "%s.%s" % (row['tab_nspname'], row['tab_relname']),
+            'comment': row['tab_comment'] or '',
+            'key': row['tab_idxname'],
+            'writes': int(row['writes']),
+            'size': int(row['size']),
+        })
+    # statistics are snapshotted per transaction
+    cursor.connection.commit()
+    return tables
+
+# Sequences of the set in the form slony_table takes them
+def set_sequences(cursor, cluster_name, set_id):
+    return [{'id': r['seq_id'],
+             'fqname': "%s.%s" % (r['seq_nspname'], r['seq_relname']),
+             'comment': r['seq_comment'] or ''} for r in replicated_sequences(cursor, cluster_name, set_id)]
+
+# Turns two readings of the counters into writes per second
+def write_rates(before, after, seconds):
+    counted = dict( (t['id'], t['writes']) for t in before )
+    for table in after:
+        table['writes'] = max(table['writes'] - counted.get(table['id'], 0), 0) / float(seconds)
+    return after
+
+# Each table is weighed by its share of all writes and of all data, so that
+# a single hot table ends up in a set of its own
+def balance_tables(tables, set_count, write_weight):
+    total_writes = sum(t['writes'] for t in tables) or 1
+    total_size = sum(t['size'] for t in tables) or 1
+    def weight(table):
+        return (write_weight * table['writes'] / float(total_writes)
+                + (1 - write_weight) * table['size'] / float(total_size))
+
+    return [sorted(b, key=lambda t: t['id']) for b in balance_buckets(tables, set_count, weight)]
+
+# ===========================================
+# Module execution.
+#
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            port=dict(default="5432"),
+            cluster_name=dict(default="replication"),
+            replication_user=dict(default="postgres"),
+            password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
+            db=dict(required=True),
+            host=dict(required=True),
+            set_id=dict(required=True),
+            set_count=dict(required=True, type='int'),
+            first_new_set_id=dict(default=None, type='int'),
+            write_weight=dict(default=0.5, type='float'),
+            sample_seconds=dict(default=0, type='int'),
+        ),
+        supports_check_mode = True
+    )
+
+    port = module.params["port"]
+    cluster_name = module.params["cluster_name"]
+    replication_user = module.params["replication_user"]
+    password = module.params["password"]
+    db = module.params["db"]
+    host = module.params["host"]
+    set_id = int(module.params["set_id"])
+    set_count = module.params["set_count"]
+    first_new_set_id = module.params["first_new_set_id"]
+    write_weight = module.params["write_weight"]
+    sample_seconds = module.params["sample_seconds"]
+
+    if set_count < 1:
+        module.fail_json(msg="set_count must be at least 1")
+    if write_weight < 0 or write_weight > 1:
+        module.fail_json(msg="write_weight must be between 0 and 1")
+
+    try:
+        db_connection = connect(module, build_conninfo(host, db, replication_user, port, password))
+        cursor = dict_cursor(db_connection)
+    except Exception, e:
+        module.fail_json(msg="unable to connect to database: %s" % e)
+
+    if not schema_exists(cursor, cluster_name):
+        module.fail_json(msg="cluster %s is not installed on %s/%s" % (cluster_name, host, db))
+
+    origin_id = set_origin(cursor, cluster_name, set_id)
+    if origin_id is None:
+        module.fail_json(msg="set %s does not exist" % set_id)
+
+    tables = table_activity(cursor, cluster_name, set_id)
+    if sample_seconds > 0:
+        time.sleep(sample_seconds)
+        tables = write_rates(tables, table_activity(cursor, cluster_name, set_id), sample_seconds)
+
+    if first_new_set_id is None:
+        first_new_set_id = next_set_id(cursor, cluster_name)
+
+    result = {}
+    result['changed'] = False
+    result['proposal'] = []
+    result['stats'] = []
+
+    for (i, bucket) in enumerate(balance_tables(tables, set_count, write_weight)):
+        if i == 0:
+            proposed_set_id = set_id
+            sequences = set_sequences(cursor, cluster_name, set_id)
+        else:
+            proposed_set_id = first_new_set_id + i - 1
+            sequences = []
+        result['proposal'].append({
+            'set_id': proposed_set_id,
+            'origin_id': origin_id,
+            'tables': [{'id': t['id'], 'fqname': t['fqname'], 'comment': t['comment'], 'key': t['key']} for t in bucket],
+            'sequences': sequences,
+        })
+        result['stats'].append({
+            'set_id': proposed_set_id,
+            'tables': len(bucket),
+            'writes': sum(t['writes'] for t in bucket),
+            'size_bytes': sum(t['size'] for t in bucket),
+        })
+
+    module.exit_json(**result)
+
+from ansible.module_utils.basic import *
+main()
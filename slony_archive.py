@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = '''
+---
+module: slony_archive
+author: Alexandr Kurilin
+version_added: "1.9"
+short_description: Apply Slony-I log shipping archives to an offline node
+requirements: [psycopg2, psql]
+description:
+    - Applies the archive files written by a slon with archive_dir set (see
+      slony_slon) to a log shipping node that has no libpq path to the rest
+      of the cluster
+    - The node must have been seeded with slony1_dump.sh, which creates the
+      sl_archive_tracking table holding the number of the last applied
+      archive. Only newer archives are applied, strictly in order, and
+      application stops at the first gap.
+    - Files are streamed through psql rather than read into memory, as a
+      single archive can cover a lot of SYNCs
+'''
+
+EXAMPLES = '''
+# Run on the WAN replica after the archives have been copied over
+- slony_archive: host=localhost db=app archive_dir=/var/lib/slony1/incoming remove_applied=yes
+'''
+
+import os
+import re
+
+from ansible.module_utils.slony.common import build_conninfo, connect, dict_cursor
+
+ARCHIVE_FILE = re.compile(r'^slony1_log_(\d+)_(\d+)\.sql$')
+
+# ===========================================
+# Postgres / archive support methods.
+#
+
+def last_applied_archive(cursor, cluster_name):
+    query = """SELECT 1 FROM pg_catalog.pg_class c
+               JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+               WHERE n.nspname = %s AND c.relname = 'sl_archive_tracking'"""
+    cursor.execute(query, ("_" + cluster_name,))
+    if cursor.rowcount != 1:
+        return None
+    cursor.execute("SELECT at_counter FROM _{0}.sl_archive_tracking".format(cluster_name))
+    return int(cursor.fetchone()[0])
+
+# Archives numbered after last_applied, in order, up to the first missing one
+def pending_archives(archive_dir, last_applied):
+    archives = {}
+    for name in os.listdir(archive_dir):
+        match = ARCHIVE_FILE.match(name)
+        if match:
+            archives[int(match.group(2))] = os.path.join(archive_dir, name)
+
+    pending = []
+    counter = last_applied + 1
+    while counter in archives:
+        pending.append((counter, archives[counter]))
+        counter += 1
+
+    later = [c for c in archives if c > counter]
+    if later:
+        gap = counter
+    else:
+        gap = None
+    return (pending, gap)
+
+# Every archive carries its own transaction, so a failed one leaves
+# the tracking counter where it was. The password goes through the
+# environment, anything on the command line shows up in ps.
+def apply_archive(module, host, db, replication_user, port, password, path):
+    cmd = ["psql", "-X", "-q", "-v", "ON_ERROR_STOP=1",
+           "-h", host, "-p", str(port), "-U", replication_user, "-d", db, "-f", path]
+    environ = {}
+    if password:
+        environ['PGPASSWORD'] = password
+    return module.run_command(cmd, environ_update=environ)
+
+# ===========================================
+# Module execution.
+#
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            port=dict(default="5432"),
+            cluster_name=dict(default="replication"),
+            replication_user=dict(default="postgres"),
+            password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
+            db=dict(required=True),
+            host=dict(required=True),
+            archive_dir=dict(required=True),
+            max_files=dict(default=0, type='int'),
+            remove_applied=dict(default=False, type='bool'),
+        ),
+        supports_check_mode = False
+    )
+
+    port = module.params["port"]
+    cluster_name = module.params["cluster_name"]
+    replication_user = module.params["replication_user"]
+    password = module.params["password"]
+    db = module.params["db"]
+    host = module.params["host"]
+    archive_dir = module.params["archive_dir"]
+    max_files = module.params["max_files"]
+    remove_applied = module.params["remove_applied"]
+
+    conninfo = build_conninfo(host, db, replication_user, port, password)
+
+    try:
+        db_connection = connect(module, conninfo)
+        db_connection.set_isolation_level(0)
+        cursor = dict_cursor(db_connection)
+    except Exception, e:
+        module.fail_json(msg="unable to connect to database: %s" % e)
+
+    if not os.path.isdir(archive_dir):
+        module.fail_json(msg="archive directory %s does not exist" % archive_dir)
+
+    last_applied = last_applied_archive(cursor, cluster_name)
+    if last_applied is None:
+        module.fail_json(msg="%s/%s has no _%s.sl_archive_tracking table, seed it with slony1_dump.sh first" % (host, db, cluster_name))
+
+    (pending, gap) = pending_archives(archive_dir, last_applied)
+    if max_files > 0:
+        pending = pending[:max_files]
+
+    result = {}
+    result['applied'] = []
+
+    for (counter, path) in pending:
+        (rc, out, err) = apply_archive(module, host, db, replication_user, port, password, path)
+        if rc != 0:
+            module.fail_json(stdout=out, msg="applying %s failed: %s" % (path, err), rc=rc,
+                             applied=result['applied'], last_applied=last_applied)
+        last_applied = counter
+        result['applied'].append(counter)
+        if remove_applied:
+            os.unlink(path)
+
+    result['last_applied'] = last_applied
+    result['changed'] = len(result['applied']) > 0
+    # A gap means an archive went missing in transit, nothing past it can
+    # ever be applied until it turns up
+    if gap is not None and gap == last_applied + 1:
+        result['missing_archive'] = gap
+
+    module.exit_json(**result)
+
+from ansible.module_utils.basic import *
+main()
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = '''
+---
+module: slony_audit
+author: Alexandr Kurilin
+version_added: "1.9"
+short_description: Find drift between the slony catalog and the real tables
+requirements: [psycopg2]
+description:
+    - Checks every replicated table and sequence in sl_table / sl_sequence
+      against pg_class and pg_trigger on each node given, with one query per
+      node, and reports every mismatch found
+    - Catches tables that were dropped, renamed, or dropped and recreated
+      under the same name (leaving a stale tab_reloid behind), and tables
+      missing the slony log or deny access triggers. Any of these stalls
+      replication without an obvious error.
+'''
+
+EXAMPLES = '''
+- slony_audit:
+    nodes:
+      - { id: 1, host: db1, db: app }
+      - { id: 2, host: db2, db: app }
+    fail_on_drift: yes
+'''
+
+from ansible.module_utils.slony.common import build_conninfo, connect, dict_cursor
+
+# ===========================================
+# Postgres / slony support methods.
+#
+
+# Only the broken rows come back, so a healthy cluster with tens of
+# thousands of tables costs one index-driven scan per node and an empty
+# result set
+def catalog_drift(cursor, cluster_name):
+    query = """SELECT * FROM (
+                 SELECT 'table' AS kind, t.tab_id AS id, t.tab_set AS set_id,
+                        t.tab_nspname AS nspname, t.tab_relname AS relname,
+                        t.tab_reloid AS catalog_oid, c.oid AS actual_oid,
+                        r.relname AS reloid_relname,
+                        EXISTS (SELECT 1 FROM pg_catalog.pg_trigger tg
+                                WHERE tg.tgrelid = c.oid AND tg.tgname = %(logtrigger)s) AS has_logtrigger,
+                        EXISTS (SELECT 1 FROM pg_catalog.pg_trigger tg
+                                WHERE tg.tgrelid = c.oid AND tg.tgname = %(denyaccess)s) AS has_denyaccess
+                 FROM _{0}.sl_table t
+                 LEFT JOIN pg_catalog.pg_namespace n ON n.nspname = t.tab_nspname
+                 LEFT JOIN pg_catalog.pg_class c ON c.relnamespace = n.oid
+                                                 AND c.relname = t.tab_relname
+                 LEFT JOIN pg_catalog.pg_class r ON r.oid = t.tab_reloid
+                 UNION ALL
+                 SELECT 'sequence', s.seq_id, s.seq_set,
+                        s.seq_nspname, s.seq_relname,
+                        s.seq_reloid, c.oid,
+                        r.relname,
+                        true, true
+                 FROM _{0}.sl_sequence s
+                 LEFT JOIN pg_catalog.pg_namespace n ON n.nspname = s.seq_nspname
+                 LEFT JOIN pg_catalog.pg_class c ON c.relnamespace = n.oid
+                                                 AND c.relname = s.seq_relname
+                 LEFT JOIN pg_catalog.pg_class r ON r.oid = s.seq_reloid
+               ) objects
+               WHERE actual_oid IS NULL
+               OR actual_oid <> catalog_oid
+               OR NOT has_logtrigger
+               OR NOT has_denyaccess
+               ORDER BY kind, id""".format(cluster_name)
+    cursor.execute(query, {'logtrigger': "_%s_logtrigger" % cluster_name,
+                           'denyaccess': "_%s_denyaccess" % cluster_name})
+    return cursor.fetchall()
+
+def describe_drift(row):
+    issues = []
+    if row['actual_oid'] is None:
+        if row['reloid_relname'] is not None:
+            issues.append("renamed to %s" % row['reloid_relname'])
+        else:
+            issues.append("missing")
+    elif row['actual_oid'] != row['catalog_oid']:
+        issues.append("stale reloid %s, the relation by that name is now %s" % (row['catalog_oid'], row['actual_oid']))
+    if row['actual_oid'] is not None:
+        if not row['has_logtrigger']:
+            issues.append("log trigger missing")
+        if not row['has_denyaccess']:
+            issues.append("deny access trigger missing")
+    return issues
+
+# ===========================================
+# Module execution.
+#
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            port=dict(default="5432"),
+            cluster_name=dict(default="replication"),
+            replication_user=dict(default="postgres"),
+            password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
+            nodes=dict(required=True, type='list'),
+            fail_on_drift=dict(default=False, type='bool'),
+        ),
+        supports_check_mode = True
+    )
+
+    port = module.params["port"]
+    cluster_name = module.params["cluster_name"]
+    replication_user = module.params["replication_user"]
+    password = module.params["password"]
+    nodes = module.params["nodes"]
+    fail_on_drift = module.params["fail_on_drift"]
+
+    result = {}
+    result['changed'] = False
+    result['drift'] = []
+    result['unreachable'] = []
+
+    for node in nodes:
+        conninfo = build_conninfo(node['host'], node['db'], replication_user, port, password)
+        try:
+            db_connection = connect(module, conninfo)
+            cursor = dict_cursor(db_connection)
+            rows = catalog_drift(cursor, cluster_name)
+            db_connection.close()
+        except Exception, e:
+            result['unreachable'].append({'node': node['id'], 'msg': str(e)})
+            continue
+
+        for row in rows:
+            result['drift'].append({
+                'node': node['id'],
+                'kind': row['kind'],
+                'id': row['id'],
+                'set_id': row['set_id'],
+                'fqname': "%s.%s" % (row['nspname'], row['relname']),
+                'issues': describe_drift(row),
+            })
+
+    if fail_on_drift and (result['drift'] or result['unreachable']):
+        module.fail_json(msg="found %s drifted objects, %s nodes could not be audited"
+                         % (len(result['drift']), len(result['unreachable'])), **result)
+
+    module.exit_json(**result)
+
+from ansible.module_utils.basic import *
+main()
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = '''
+---
+module: slony_clone
+author: Alexandr Kurilin
+version_added: "1.9"
+short_description: Add a slony node by cloning an existing subscriber
+requirements: [psycopg2, slonik]
+description:
+    - Adds a new node to a Slony-I cluster as a copy of an existing subscriber
+      using CLONE PREPARE / CLONE FINISH, so the new node doesn't need a
+      logical copy of every set
+    - The database copy itself is done by copy_command, run between the two
+      slonik steps. It gets the provider and clone conninfos in the
+      SLONY_PROVIDER_CONNINFO and SLONY_CLONE_CONNINFO environment variables.
+    - slave_host / slave_db must be a database of its own. The module refuses
+      to run when it is the provider's database, or a node other than the
+      clone already. The copy is only skipped on a rerun when clone prepare
+      has registered the clone and the slave holds a copy of the provider.
+    - Once the clone is finished, paths are stored in both directions between
+      the clone and the origin, the provider and any extra path_nodes
+'''
+
+EXAMPLES = '''
+- slony_clone:
+    origin_host: db1
+    origin_db: app
+    origin_id: 1
+    master_host: db2
+    master_db: app
+    slave_host: db3
+    slave_db: app
+    provider_id: 2
+    clone_id: 3
+    copy_command: "pg_dump -Fc \\"$SLONY_PROVIDER_CONNINFO\\" | pg_restore -d \\"$SLONY_CLONE_CONNINFO\\""
+'''
+
+from ansible.module_utils.slony.common import build_conninfo, connect, dict_cursor, schema_exists
+from ansible.module_utils.slony.slonik import fail_slonik, run_slonik, slonik_script
+
+# ===========================================
+# Postgres / slonik support methods.
+#
+
+def node_exists(cursor, cluster_name, node_id):
+    query = "SELECT 1 FROM _{0}.sl_node WHERE no_id = %s".format(cluster_name)
+    cursor.execute(query, (int(node_id),))
+    return cursor.rowcount == 1
+
+# A database copied off the provider still thinks it is the provider until
+# clone finish has run against it
+def local_node_id(cursor, cluster_name):
+    cursor.execute("SELECT _{0}.getLocalNodeId(%s)".format(cluster_name), ("_" + cluster_name,))
+    return cursor.fetchone()[0]
+
+# A server's start time is as good as unique, with the port and database name
+# it tells two connections to the same database apart from a copy of it
+def database_identity(cursor):
+    cursor.execute("SELECT pg_catalog.pg_postmaster_start_time(), pg_catalog.inet_server_port(), pg_catalog.current_database()")
+    return tuple(cursor.fetchone())
+
+def clone_prepare(module, cluster_name, origin_conninfo, provider_conninfo, origin_id, provider_id, clone_id, comment):
+    cmd = slonik_script(cluster_name,
+                        [(origin_id, origin_conninfo), (provider_id, provider_conninfo)],
+                        ["clone prepare (id=%s, provider=%s, comment='%s');" % (clone_id, provider_id, comment),
+                         "sync (id=%s);" % origin_id,
+                         "wait for event (origin=%s, confirmed=%s, wait on=%s, timeout=0);" % (origin_id, provider_id, origin_id)])
+
+    return run_slonik(module, cmd)
+
+# path_nodes is a list of (node_id, conninfo) the clone should talk to
+def clone_finish(module, cluster_name, provider_conninfo, clone_conninfo, provider_id, clone_id, path_nodes):
+    paths = []
+    for (node_id, conninfo) in path_nodes:
+        paths.append("store path (server=%s, client=%s, conninfo='%s');" % (node_id, clone_id, conninfo))
+        paths.append("store path (server=%s, client=%s, conninfo='%s');" % (clone_id, node_id, clone_conninfo))
+    admin_nodes = [(provider_id, provider_conninfo), (clone_id, clone_conninfo)]
+    for (node_id, conninfo) in path_nodes:
+        if node_id != provider_id:
+            admin_nodes.append((node_id, conninfo))
+
+    cmd = slonik_script(cluster_name, admin_nodes,
+                        ["clone finish (id=%s, provider=%s);" % (clone_id, provider_id)] + paths)
+
+    return run_slonik(module, cmd)
+
+def copy_database(module, copy_command, provider_conninfo, clone_conninfo):
+    return module.run_command(copy_command, use_unsafe_shell=True,
+                              environ_update={'SLONY_PROVIDER_CONNINFO': provider_conninfo,
+                                              'SLONY_CLONE_CONNINFO': clone_conninfo})
+
+# ===========================================
+# Module execution.
+#
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            port=dict(default="5432"),
+            cluster_name=dict(default="replication"),
+            replication_user=dict(default="postgres"),
+            password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
+            origin_db=dict(required=True),
+            origin_host=dict(required=True),
+            origin_id=dict(required=True),
+            master_db=dict(required=True),
+            master_host=dict(required=True),
+            slave_db=dict(required=True),
+            slave_host=dict(required=True),
+            provider_id=dict(required=True),
+            clone_id=dict(required=True),
+            copy_command=dict(required=True),
+            comment=dict(default=""),
+            path_nodes=dict(default=[], type='list'),
+            slonik_retries=dict(default=5, type='int'),
+            slonik_retry_delay=dict(default=1, type='float'),
+        ),
+        supports_check_mode = False
+    )
+
+    port = module.params["port"]
+    cluster_name = module.params["cluster_name"]
+    replication_user = module.params["replication_user"]
+    password = module.params["password"]
+    origin_db = module.params["origin_db"]
+    origin_host = module.params["origin_host"]
+    origin_id = int(module.params["origin_id"])
+    master_db = module.params["master_db"]
+    master_host = module.params["master_host"]
+    slave_db = module.params["slave_db"]
+    slave_host = module.params["slave_host"]
+    provider_id = int(module.params["provider_id"])
+    clone_id = int(module.params["clone_id"])
+    copy_command = module.params["copy_command"]
+    comment = module.params["comment"] or "Node %s - clone of node %s" % (clone_id, provider_id)
+    path_nodes = module.params["path_nodes"]
+
+    origin_conninfo = build_conninfo(origin_host, origin_db, replication_user, port, password)
+    master_conninfo = build_conninfo(master_host, master_db, replication_user, port, password)
+    slave_conninfo = build_conninfo(slave_host, slave_db, replication_user, port, password)
+
+    if provider_id == origin_id:
+        module.fail_json(msg="the provider must be a subscriber, clone prepare can't copy the origin")
+    if master_conninfo == slave_conninfo:
+        module.fail_json(msg="slave_host/slave_db is the provider's database, refusing to turn the provider into the clone")
+
+    # The clone talks to the origin and its provider, plus whatever else
+    # the caller wants it connected to
+    paths = [(origin_id, origin_conninfo), (provider_id, master_conninfo)]
+    for node in path_nodes:
+        node_conninfo = build_conninfo(node['host'], node['db'], replication_user, port, password)
+        if int(node['id']) not in (origin_id, provider_id, clone_id):
+            paths.append((int(node['id']), node_conninfo))
+
+    try:
+        db_connection_master = connect(module, master_conninfo)
+        db_connection_slave = connect(module, slave_conninfo)
+        db_connection_master.set_isolation_level(0)
+        db_connection_slave.set_isolation_level(0)
+        master_cursor = dict_cursor(db_connection_master)
+        slave_cursor = dict_cursor(db_connection_slave)
+    except Exception, e:
+        module.fail_json(msg="unable to connect to database: %s" % e)
+
+    if database_identity(master_cursor) == database_identity(slave_cursor):
+        module.fail_json(msg="%s/%s is the provider's database, refusing to turn the provider into the clone" % (slave_host, slave_db))
+
+    result = {}
+
+    # A copy of the provider that clone finish hasn't run against yet still
+    # reports the provider's node id
+    slave_node_id = None
+    if schema_exists(slave_cursor, cluster_name):
+        slave_node_id = local_node_id(slave_cursor, cluster_name)
+    if slave_node_id == clone_id:
+        result['changed'] = False
+        module.exit_json(**result)
+    if slave_node_id not in (None, provider_id):
+        module.fail_json(msg="%s/%s is already node %s, refusing to copy over it" % (slave_host, slave_db, slave_node_id))
+
+    # A previous run may have died after clone prepare, in which case the
+    # node is already registered and only the copy and finish are left
+    clone_registered = node_exists(master_cursor, cluster_name, clone_id)
+    if not clone_registered:
+        (rc, out, err) = clone_prepare(module, cluster_name, origin_conninfo, master_conninfo, origin_id, provider_id, clone_id, comment)
+        if rc != 0:
+            fail_slonik(module, rc, out, err)
+
+    # the copy will replace the clone's database, don't hold it open
+    db_connection_slave.close()
+
+    # A previous run may also have died after the copy, copying again would
+    # fail or restore over it. A copy taken before clone prepare is no good.
+    copy_is_done = clone_registered and slave_node_id == provider_id
+    if not copy_is_done:
+        (rc, out, err) = copy_database(module, copy_command, master_conninfo, slave_conninfo)
+        if rc != 0:
+            module.fail_json(stdout=out, msg="copy_command failed: %s" % err, rc=rc)
+
+    (rc, out, err) = clone_finish(module, cluster_name, master_conninfo, slave_conninfo, provider_id, clone_id, paths)
+    if rc != 0:
+        fail_slonik(module, rc, out, err)
+
+    result['changed'] = True
+    result['copied'] = not copy_is_done
+    result['paths'] = [node_id for (node_id, conninfo) in paths]
+
+    module.exit_json(**result)
+
+from ansible.module_utils.basic import *
+main()
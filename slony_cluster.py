@@ -17,53 +17,28 @@ EXAMPLES = '''
 - slony_cluster: name=replication
 '''
 
-try:
-    import psycopg2
-    import psycopg2.extras
-except ImportError:
-    postgresqldb_found = False
-else:
-    postgresqldb_found = True
+from ansible.module_utils.slony.common import build_conninfo, connect, connection_kwargs, dict_cursor, schema_exists
+from ansible.module_utils.slony.slonik import ALREADY_PRESENT, fail_slonik, run_slonik, slonik_script
 
 # ===========================================
 # Postgres / slonik support methods.
 #
 
-# def execute_command(module, cmd, use_unsafe_shell=False, data=None):
-#     # if module.syslogging:
-#     #     syslog.openlog('ansible-%s' % os.path.basename(__file__))
-#     #     syslog.syslog(syslog.LOG_NOTICE, 'Command %s' % '|'.join(cmd))
-#     return module.run_command(module, cmd, use_unsafe_shell=use_unsafe_shell, data=data)
-
-def schema_exists(cursor, cluster_name):
-    query = "SELECT * FROM pg_catalog.pg_namespace WHERE nspname=%(schema)s"
-    cursor.execute(query, {'schema': "_" + cluster_name})
-    return cursor.rowcount == 1
-
 # TODO: this should do drop node first, wait and then proceed with uninstall
 # but it's not working for some reason, investigate
 def remove_cluster(module, host, db, replication_user, cluster_name, password, port):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node 1 admin conninfo='host=%s dbname=%s user=%s port=%s password=%s';
-    uninstall node (id = 1);
-_EOF_
-    """ % (cluster_name, host, db, replication_user, port, password)
+    cmd = slonik_script(cluster_name,
+                        [(1, build_conninfo(host, db, replication_user, port, password))],
+                        ["uninstall node (id = 1);"])
 
-    return module.run_command(cmd, use_unsafe_shell=True)
+    return run_slonik(module, cmd)
 
 def init_cluster(module, host, db, cluster_name, replication_user, password, port, origin_id):
-    cmd = """slonik <<_EOF_
-    # INIT CLUSTER
-    cluster name = %s;
-    node 1 admin conninfo='host=%s dbname=%s user=%s port=%s password=%s';
-    init cluster (id = %s, comment = 'Node 1 - %s@%s');
-_EOF_""" % (cluster_name,
-            host, db, replication_user, port, password,
-            origin_id, db, host)
+    cmd = slonik_script(cluster_name,
+                        [(1, build_conninfo(host, db, replication_user, port, password))],
+                        ["init cluster (id = %s, comment = 'Node 1 - %s@%s');" % (origin_id, db, host)])
 
-    return module.run_command(cmd, use_unsafe_shell=True)
+    return run_slonik(module, cmd, done=ALREADY_PRESENT)
 
 # ===========================================
 # Module execution.
@@ -76,17 +51,17 @@ def main():
             cluster_name=dict(default="replication"),
             replication_user=dict(default="postgres"),
             password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
             db=dict(required=True),
             host=dict(required=True),
             origin_id=dict(default=1),
+            slonik_retries=dict(default=5, type='int'),
+            slonik_retry_delay=dict(default=1, type='float'),
             state=dict(default="present", choices=["absent", "present"]),
         ),
         supports_check_mode = False
     )
 
-    if not postgresqldb_found:
-        module.fail_json(msg="the python psycopg2 module is required")
-
     port = module.params["port"]
     state = module.params["state"]
     cluster_name = module.params["cluster_name"]
@@ -97,27 +72,17 @@ def main():
     origin_id = module.params["origin_id"]
     changed = False
 
-    # To use defaults values, keyword arguments must be absent, so
-    # check which values are empty and don't include in the **kw
-    # dictionary
-    params_map = {
-        "password":"password",
-        "port":"port"
-    }
-
-    kw = dict( (params_map[k], v) for (k, v) in module.params.iteritems()
-              if k in params_map and v != '' )
+    kw = connection_kwargs(module)
 
     try:
         # TODO: this probably gets overwritten by contents of kw which can lead
         # to a total poopshow
-        db_connection_master = psycopg2.connect(
+        db_connection_master = connect(module,
                 database=db,
                 host=host,
                 user=replication_user,
                 **kw)
-        cursor_master = db_connection_master.cursor(
-                cursor_factory=psycopg2.extras.DictCursor)
+        cursor_master = dict_cursor(db_connection_master)
 
     # TODO: want to be clearer about which DB connection failed to init
     except Exception, e:
@@ -131,7 +96,7 @@ def main():
             (rc, out, err) = remove_cluster(module, host, db, replication_user, cluster_name, password, port)
             result['changed'] = True
             if rc != 0:
-                module.fail_json(stdout=out,msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
             # TODO: remove for prod
             # result['stdout'] = out
         else:
@@ -146,7 +111,7 @@ def main():
             # TODO: remove for prod
             # result['stdout'] = out
             if rc != 0:
-                module.fail_json(stdout=out, msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
             result['changed'] = True
 
     module.exit_json(**result)
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = '''
+---
+module: slony_maintenance
+author: Alexandr Kurilin
+version_added: "1.9"
+short_description: Report on and clean up Slony-I log and event tables
+requirements: [psycopg2]
+description:
+    - Reports row counts and on-disk sizes of sl_log_1, sl_log_2, sl_event and
+      sl_confirm on a node, along with the oldest event that has not been
+      confirmed by every receiver and is therefore holding back cleanup
+    - Optionally starts a log switch, runs event cleanup and vacuums the log
+      tables when the configured thresholds are crossed
+'''
+
+EXAMPLES = '''
+# Report only
+- slony_maintenance: host={{ item }} db=app
+  with_items: slony_nodes
+
+# Clean up once the log tables grow past a million rows or 1GB
+- slony_maintenance: host=db1 db=app cleanup=yes vacuum=yes log_rows_threshold=1000000 log_bytes_threshold=1073741824
+'''
+
+from ansible.module_utils.slony.common import connect, connection_kwargs, dict_cursor, schema_exists
+
+LOG_TABLES = ["sl_log_1", "sl_log_2"]
+EVENT_TABLES = ["sl_event", "sl_confirm"]
+
+# ===========================================
+# Postgres / slony support methods.
+#
+
+# reltuples is only an estimate but count(*) on a bloated sl_log_1 is exactly
+# the kind of load we're trying to get rid of
+def table_stats(cursor, cluster_name, tables):
+    query = """SELECT c.relname,
+                      c.reltuples::bigint AS row_estimate,
+                      pg_catalog.pg_total_relation_size(c.oid) AS total_bytes,
+                      s.n_dead_tup,
+                      s.last_vacuum,
+                      s.last_autovacuum
+               FROM pg_catalog.pg_class c
+               JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+               LEFT JOIN pg_catalog.pg_stat_user_tables s ON s.relid = c.oid
+               WHERE n.nspname = %s
+               AND c.relname = ANY(%s)"""
+    cursor.execute(query, ("_" + cluster_name, tables))
+    stats = {}
+    for row in cursor.fetchall():
+        stats[row['relname']] = {
+            'rows': max(int(row['row_estimate']), 0),
+            'bytes': int(row['total_bytes']),
+            'dead_rows': row['n_dead_tup'],
+            'last_vacuum': str(row['last_vacuum'] or row['last_autovacuum'] or ''),
+        }
+    return stats
+
+# The oldest event, from any origin, that at least one receiver has not
+# confirmed yet. cleanupEvent() can't remove anything newer than this, nor
+# the sl_log rows that belong to it.
+def oldest_unconfirmed_event(cursor, cluster_name):
+    query = """SELECT e.ev_origin, e.ev_seqno, e.ev_type, e.ev_timestamp,
+                      c.con_received AS blocked_by,
+                      pg_catalog.now() - e.ev_timestamp AS age
+               FROM _{0}.sl_event e
+               JOIN (SELECT con_origin, con_received, max(con_seqno) AS con_seqno
+                     FROM _{0}.sl_confirm
+                     GROUP BY con_origin, con_received) c
+                 ON c.con_origin = e.ev_origin
+                AND c.con_seqno < e.ev_seqno
+               ORDER BY e.ev_timestamp, e.ev_seqno
+               LIMIT 1""".format(cluster_name)
+    cursor.execute(query)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return {
+        'origin': row['ev_origin'],
+        'seqno': int(row['ev_seqno']),
+        'type': row['ev_type'],
+        'timestamp': str(row['ev_timestamp']),
+        'age': str(row['age']),
+        'blocked_by': row['blocked_by'],
+    }
+
+# sl_log_status is 0 or 1 when sl_log_1 or sl_log_2 is in use and no switch
+# is running, 2 or 3 while a switch is in progress
+def logswitch_in_progress(cursor, cluster_name):
+    cursor.execute("SELECT last_value FROM _{0}.sl_log_status".format(cluster_name))
+    return cursor.fetchone()[0] > 1
+
+def logswitch_start(cursor, cluster_name):
+    cursor.execute("SELECT _{0}.logswitch_start()".format(cluster_name))
+
+def cleanup_events(cursor, cluster_name, interval):
+    cursor.execute("SELECT _{0}.cleanupEvent(%s::interval)".format(cluster_name), (interval,))
+
+def vacuum_table(cursor, cluster_name, table):
+    cursor.execute('VACUUM ANALYZE "_{0}".{1}'.format(cluster_name, table))
+
+# ===========================================
+# Module execution.
+#
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            port=dict(default="5432"),
+            cluster_name=dict(default="replication"),
+            replication_user=dict(default="postgres"),
+            password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
+            db=dict(required=True),
+            host=dict(required=True),
+            cleanup=dict(default=False, type='bool'),
+            vacuum=dict(default=False, type='bool'),
+            cleanup_interval=dict(default="10 minutes"),
+            log_rows_threshold=dict(default=1000000, type='int'),
+            log_bytes_threshold=dict(default=1073741824, type='int'),
+            event_rows_threshold=dict(default=100000, type='int'),
+        ),
+        supports_check_mode = False
+    )
+
+    port = module.params["port"]
+    cluster_name = module.params["cluster_name"]
+    replication_user = module.params["replication_user"]
+    password = module.params["password"]
+    db = module.params["db"]
+    host = module.params["host"]
+    cleanup = module.params["cleanup"]
+    vacuum = module.params["vacuum"]
+    cleanup_interval = module.params["cleanup_interval"]
+    log_rows_threshold = module.params["log_rows_threshold"]
+    log_bytes_threshold = module.params["log_bytes_threshold"]
+    event_rows_threshold = module.params["event_rows_threshold"]
+
+    kw = connection_kwargs(module)
+
+    try:
+        db_connection = connect(module,
+                database=db,
+                host=host,
+                user=replication_user,
+                **kw)
+        # VACUUM can't run inside a transaction block
+        db_connection.set_isolation_level(0)
+        cursor = dict_cursor(db_connection)
+
+    except Exception, e:
+        module.fail_json(msg="unable to connect to database: %s" % e)
+
+    if not schema_exists(cursor, cluster_name):
+        module.fail_json(msg="cluster %s is not installed on %s/%s" % (cluster_name, host, db))
+
+    result = {}
+    result['changed'] = False
+
+    stats = table_stats(cursor, cluster_name, LOG_TABLES + EVENT_TABLES)
+    result['tables'] = stats
+    result['oldest_unconfirmed_event'] = oldest_unconfirmed_event(cursor, cluster_name)
+
+    log_rows = sum(stats[t]['rows'] for t in LOG_TABLES if t in stats)
+    log_bytes = sum(stats[t]['bytes'] for t in LOG_TABLES if t in stats)
+    event_rows = sum(stats[t]['rows'] for t in EVENT_TABLES if t in stats)
+
+    log_over_threshold = log_rows > log_rows_threshold or log_bytes > log_bytes_threshold
+    events_over_threshold = event_rows > event_rows_threshold
+    result['thresholds_crossed'] = log_over_threshold or events_over_threshold
+
+    actions = []
+    try:
+        if cleanup and events_over_threshold:
+            cleanup_events(cursor, cluster_name, cleanup_interval)
+            actions.append("cleanupEvent")
+
+        if cleanup and log_over_threshold:
+            # Starting a switch while one is still running raises, and the
+            # running one will truncate the old log once it's done anyway
+            if not logswitch_in_progress(cursor, cluster_name):
+                logswitch_start(cursor, cluster_name)
+                actions.append("logswitch_start")
+
+        if vacuum:
+            tables = []
+            if log_over_threshold:
+                tables.extend(LOG_TABLES)
+            if events_over_threshold:
+                tables.extend(EVENT_TABLES)
+            for table in tables:
+                vacuum_table(cursor, cluster_name, table)
+                actions.append("vacuum %s" % table)
+
+    except Exception, e:
+        module.fail_json(msg="maintenance failed after %s: %s" % (actions, e))
+
+    result['actions'] = actions
+    result['changed'] = len(actions) > 0
+
+    module.exit_json(**result)
+
+from ansible.module_utils.basic import *
+main()
@@ -10,6 +10,9 @@ short_description: Create / delete a slony node
 requirements: [psycopg2, slonik]
 description:
     - Manage a Slony-I node
+    - Setting max_lag_events and/or max_lag_seconds makes the module wait,
+      for up to lag_timeout seconds, until the receivers involved are within
+      those limits before dropping a node, and fail otherwise
 '''
 
 EXAMPLES = '''
@@ -17,53 +20,32 @@ EXAMPLES = '''
 - slony_node: name=TODO
 '''
 
-try:
-    import psycopg2
-    import psycopg2.extras
-except ImportError:
-    postgresqldb_found = False
-else:
-    postgresqldb_found = True
+from ansible.module_utils.slony.common import build_conninfo, connect, dict_cursor, schema_exists
+from ansible.module_utils.slony.coordination import wait_for_lag
+from ansible.module_utils.slony.slonik import ALREADY_PRESENT, fail_slonik, run_slonik, slonik_script
 
 # ===========================================
 # Postgres / slonik support methods.
 #
 
-def schema_exists(cursor, cluster_name):
-    query = "SELECT * FROM pg_catalog.pg_namespace WHERE nspname=%(schema)s"
-    cursor.execute(query, {'schema': "_" + cluster_name})
-    return cursor.rowcount == 1
+def other_nodes(cursor, cluster_name, node_id):
+    query = "SELECT no_id FROM _{0}.sl_node WHERE no_id <> %s".format(cluster_name)
+    cursor.execute(query, (int(node_id),))
+    return [r[0] for r in cursor.fetchall()]
 
 def store_node(module, cluster_name, master_conninfo, slave_conninfo, node_id, event_node_id):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node %s admin conninfo='%s';
-    node %s admin conninfo='%s';
-    store node (id=%s, comment='', event node=%s);
-_EOF_
-    """ % (cluster_name,
-           event_node_id, master_conninfo,
-           node_id, slave_conninfo,
-           node_id, event_node_id)
-
-    return module.run_command(cmd, use_unsafe_shell=True)
+    cmd = slonik_script(cluster_name,
+                        [(event_node_id, master_conninfo), (node_id, slave_conninfo)],
+                        ["store node (id=%s, comment='', event node=%s);" % (node_id, event_node_id)])
+
+    return run_slonik(module, cmd, done=ALREADY_PRESENT)
 
 def drop_node(module, cluster_name, master_conninfo, slave_conninfo, node_id, event_node_id):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node %s admin conninfo='%s';
-    node %s admin conninfo='%s';
-    drop node (id=%s, event node=%s);
-    uninstall node (id=%s);
-_EOF_
-    """ % (cluster_name,
-           event_node_id, master_conninfo,
-           node_id, slave_conninfo,
-           node_id, event_node_id,
-           node_id)
-    return module.run_command(cmd, use_unsafe_shell=True)
+    cmd = slonik_script(cluster_name,
+                        [(event_node_id, master_conninfo), (node_id, slave_conninfo)],
+                        ["drop node (id=%s, event node=%s);" % (node_id, event_node_id),
+                         "uninstall node (id=%s);" % node_id])
+    return run_slonik(module, cmd)
 
 # ===========================================
 # Module execution.
@@ -76,20 +58,23 @@ def main():
             cluster_name=dict(default="replication"),
             replication_user=dict(default="postgres"),
             password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
             master_db=dict(required=True),
             slave_db=dict(required=True),
             master_host=dict(required=True),
             slave_host=dict(required=True),
             node_id=dict(required=True),
             event_node_id=dict(required=True),
+            max_lag_events=dict(default=None, type='int'),
+            max_lag_seconds=dict(default=None, type='int'),
+            lag_timeout=dict(default=600, type='int'),
+            slonik_retries=dict(default=5, type='int'),
+            slonik_retry_delay=dict(default=1, type='float'),
             state=dict(default="present", choices=["absent", "present"]),
         ),
         supports_check_mode = False
     )
 
-    if not postgresqldb_found:
-        module.fail_json(msg="the python psycopg2 module is required")
-
     port = module.params["port"]
     cluster_name = module.params["cluster_name"]
     replication_user = module.params["replication_user"]
@@ -104,25 +89,14 @@ def main():
     changed = False
 
 #     node 1 admin conninfo='host=%s dbname=%s user=%s port=%s password=%s';
-    master_conninfo = "host=%s dbname=%s user=%s port=%s password=%s" % (master_host, master_db, replication_user, port, password)
-    slave_conninfo = "host=%s dbname=%s user=%s port=%s password=%s" % (slave_host, slave_db, replication_user, port, password)
-
-    # To use defaults values, keyword arguments must be absent, so
-    # check which values are empty and don't include in the **kw
-    # dictionary
-    params_map = {
-        "password":"password",
-        "port":"port"
-    }
-
-    kw = dict( (params_map[k], v) for (k, v) in module.params.iteritems()
-              if k in params_map and v != '' )
+    master_conninfo = build_conninfo(master_host, master_db, replication_user, port, password)
+    slave_conninfo = build_conninfo(slave_host, slave_db, replication_user, port, password)
 
     try:
-        db_connection_master = psycopg2.connect(master_conninfo)
-        db_connection_slave = psycopg2.connect(slave_conninfo)
-        master_cursor = db_connection_master.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        slave_cursor = db_connection_slave.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        db_connection_master = connect(module, master_conninfo)
+        db_connection_slave = connect(module, slave_conninfo)
+        master_cursor = dict_cursor(db_connection_master)
+        slave_cursor = dict_cursor(db_connection_slave)
     except Exception, e:
         module.fail_json(msg="unable to connect to database: %s" % e)
 
@@ -133,10 +107,13 @@ def main():
 
     if state == "absent":
         if schema_is_present:
+            # every node has to process the drop, except the one going away
+            # which is often dropped precisely because it fell behind
+            wait_for_lag(module, master_cursor, cluster_name, other_nodes(master_cursor, cluster_name, node_id))
             (rc, out, err) = drop_node(module, cluster_name, master_conninfo, slave_conninfo, node_id, event_node_id)
             result['changed'] = True
             if rc != 0:
-                module.fail_json(stdout=out,msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
         else:
             result['changed'] = False
 
@@ -146,7 +123,7 @@ def main():
         else:
             (rc, out, err) = store_node(module, cluster_name, master_conninfo, slave_conninfo, node_id, event_node_id)
             if rc != 0:
-                module.fail_json(stdout=out, msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
             result['changed'] = True
 
     module.exit_json(**result)
@@ -10,65 +10,65 @@ short_description: Create / delete a slony path
 requirements: [psycopg2, slonik]
 description:
     - Manage a Slony-I path
+    - master_path_conninfo and slave_path_conninfo are what the slons use to
+      reach the master and the slave, and default to the admin conninfos
+      built from master_host / slave_host. Use them to keep replication
+      traffic on a separate network or pooler. A stored path whose conninfo
+      differs from the wanted one is stored again.
+    - Runs against the same cluster_name are serialized with an advisory
+      lock on the cluster's lowest numbered node, waited on for up to
+      lock_timeout seconds. When that node is neither the server nor the
+      client, lock_host and lock_db have to name its database.
 '''
 
 EXAMPLES = '''
 # Foo
 - slony_path: name=TODO
+
+# Administer over the public addresses, replicate over the private network
+- slony_path:
+    master_host: db1.example.com
+    slave_host: db2.example.com
+    master_db: app
+    slave_db: app
+    server_id: 1
+    client_id: 2
+    master_path_conninfo: "host=10.0.0.1 dbname=app user=slony sslmode=disable keepalives_idle=30"
+    slave_path_conninfo: "host=10.0.0.2 dbname=app user=slony sslmode=disable keepalives_idle=30"
 '''
 
-try:
-    import psycopg2
-    import psycopg2.extras
-except ImportError:
-    postgresqldb_found = False
-else:
-    postgresqldb_found = True
+from ansible.module_utils.slony.common import build_conninfo, connect, dict_cursor
+from ansible.module_utils.slony.coordination import cluster_lock_cursor, lock_cluster
+from ansible.module_utils.slony.slonik import ALREADY_ABSENT, fail_slonik, run_slonik, slonik_script
 
 # ===========================================
 # Postgres / slonik support methods.
 #
 
-def path_exists(cursor, cluster_name, server_id, client_id):
-    query = "SELECT 1 FROM _{0}.sl_path WHERE pa_server = %s AND pa_client = %s".format(cluster_name)
+# None when there is no such path
+def path_conninfo(cursor, cluster_name, server_id, client_id):
+    query = "SELECT pa_conninfo FROM _{0}.sl_path WHERE pa_server = %s AND pa_client = %s".format(cluster_name)
     cursor.execute(query, (int(server_id), int(client_id)))
-    return cursor.rowcount == 1
-
-# NB: this one creates TWO paths at once for the sake of sanity. If really necessary we can look into
-# decoupling this into two separate calls
-def store_path(module, cluster_name, master_conninfo, slave_conninfo, server_id, client_id):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node %s admin conninfo='%s';
-    node %s admin conninfo='%s';
-    store path (server=%s, client=%s, conninfo='%s');
-    store path (server=%s, client=%s, conninfo='%s');
-_EOF_
-    """ % (cluster_name,
-           server_id, master_conninfo,
-           client_id, slave_conninfo,
-           client_id, server_id, slave_conninfo,
-           server_id, client_id, master_conninfo,
-           )
-
-    return module.run_command(cmd, use_unsafe_shell=True)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+# paths is a list of (server, client, conninfo), storing an existing path
+# again replaces its conninfo
+def store_path(module, cluster_name, master_conninfo, slave_conninfo, server_id, client_id, paths):
+    cmd = slonik_script(cluster_name,
+                        [(server_id, master_conninfo), (client_id, slave_conninfo)],
+                        ["store path (server=%s, client=%s, conninfo='%s');" % path for path in paths])
+
+    return run_slonik(module, cmd)
 
 # Drops ONE path at a time
 def drop_path(module, cluster_name, master_conninfo, slave_conninfo, master_node_id, slave_node_id, server_id, client_id):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node %s admin conninfo='%s';
-    node %s admin conninfo='%s';
-    drop path (server=%s, client=%s);
-_EOF_
-    """ % (cluster_name,
-           master_node_id, master_conninfo,
-           slave_node_id, slave_conninfo,
-           server_id, client_id,
-           )
-    return module.run_command(cmd, use_unsafe_shell=True)
+    cmd = slonik_script(cluster_name,
+                        [(master_node_id, master_conninfo), (slave_node_id, slave_conninfo)],
+                        ["drop path (server=%s, client=%s);" % (server_id, client_id)])
+    return run_slonik(module, cmd, done=ALREADY_ABSENT)
 
 # ===========================================
 # Module execution.
@@ -81,20 +81,25 @@ def main():
             cluster_name=dict(default="replication"),
             replication_user=dict(default="postgres"),
             password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
             master_db=dict(required=True),
             slave_db=dict(required=True),
             master_host=dict(required=True),
             slave_host=dict(required=True),
             server_id=dict(required=True),
             client_id=dict(required=True),
+            master_path_conninfo=dict(default=None),
+            slave_path_conninfo=dict(default=None),
+            lock_timeout=dict(default=300, type='int'),
+            lock_host=dict(default=None),
+            lock_db=dict(default=None),
+            slonik_retries=dict(default=5, type='int'),
+            slonik_retry_delay=dict(default=1, type='float'),
             state=dict(default="present", choices=["absent", "present"]),
         ),
         supports_check_mode = False
     )
 
-    if not postgresqldb_found:
-        module.fail_json(msg="the python psycopg2 module is required")
-
     port = module.params["port"]
     cluster_name = module.params["cluster_name"]
     replication_user = module.params["replication_user"]
@@ -105,40 +110,39 @@ def main():
     slave_host = module.params["slave_host"]
     server_id = module.params["server_id"]
     client_id = module.params["client_id"]
+    master_path_conninfo = module.params["master_path_conninfo"]
+    slave_path_conninfo = module.params["slave_path_conninfo"]
     state = module.params["state"]
     changed = False
 
-    master_conninfo = "host=%s dbname=%s user=%s port=%s password=%s" % (master_host, master_db, replication_user, port, password)
-    slave_conninfo = "host=%s dbname=%s user=%s port=%s password=%s" % (slave_host, slave_db, replication_user, port, password)
-
-    # To use defaults values, keyword arguments must be absent, so
-    # check which values are empty and don't include in the **kw
-    # dictionary
-    params_map = {
-        "password":"password",
-        "port":"port"
-    }
-
-    kw = dict( (params_map[k], v) for (k, v) in module.params.iteritems()
-              if k in params_map and v != '' )
+    master_conninfo = build_conninfo(master_host, master_db, replication_user, port, password)
+    slave_conninfo = build_conninfo(slave_host, slave_db, replication_user, port, password)
+    master_path_conninfo = master_path_conninfo or master_conninfo
+    slave_path_conninfo = slave_path_conninfo or slave_conninfo
 
     try:
-        db_connection_master = psycopg2.connect(master_conninfo)
-        db_connection_slave = psycopg2.connect(slave_conninfo)
+        db_connection_master = connect(module, master_conninfo)
+        db_connection_slave = connect(module, slave_conninfo)
         db_connection_master.set_isolation_level(0)
         db_connection_slave.set_isolation_level(0)
-        master_cursor = db_connection_master.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        slave_cursor = db_connection_slave.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        master_cursor = dict_cursor(db_connection_master)
+        slave_cursor = dict_cursor(db_connection_slave)
     except Exception, e:
         module.fail_json(msg="unable to connect to database: %s" % e)
 
+    lock_cursor = cluster_lock_cursor(module, master_cursor, cluster_name,
+                                      [(server_id, master_host, master_db), (client_id, slave_host, slave_db)])
+    lock_cluster(module, lock_cursor, cluster_name)
+
     result = {}
 
     # The order of server_id and client_is is very important here, don't mess it up
     # Master must see slave as server on master's schema
     # Slave must see master as server on slave's schema
-    path_is_present_on_master = path_exists(master_cursor, cluster_name, client_id, server_id)
-    path_is_present_on_slave = path_exists(slave_cursor, cluster_name, server_id, client_id)
+    stored_on_master = path_conninfo(master_cursor, cluster_name, client_id, server_id)
+    stored_on_slave = path_conninfo(slave_cursor, cluster_name, server_id, client_id)
+    path_is_present_on_master = stored_on_master is not None
+    path_is_present_on_slave = stored_on_slave is not None
     path_is_present = path_is_present_on_master and path_is_present_on_slave
 
     if path_is_present_on_master != path_is_present_on_slave:
@@ -147,23 +151,30 @@ def main():
     elif state == "absent":
         if path_is_present:
             # drop both paths. This can't be done in a single slonik operation without locking up the
-            # tool
-            (rc1, out, err) = drop_path(module, cluster_name, master_conninfo, slave_conninfo, server_id, client_id, server_id, client_id)
-            (rc2, out, err) = drop_path(module, cluster_name, master_conninfo, slave_conninfo, server_id, client_id, client_id, server_id)
+            # tool. A path that is already gone counts as dropped.
+            for (path_server, path_client) in ((server_id, client_id), (client_id, server_id)):
+                (rc, out, err) = drop_path(module, cluster_name, master_conninfo, slave_conninfo, server_id, client_id, path_server, path_client)
+                if rc != 0:
+                    fail_slonik(module, rc, out, err, msg="dropping path from %s to %s failed" % (path_server, path_client))
             result['changed'] = True
-            if rc1 != 0 and rc2 != 0:
-                module.fail_json(stdout=out,msg=err, rc=rc)
         else:
             result['changed'] = False
 
     elif state == "present":
-        if path_is_present:
+        paths = []
+        if stored_on_master != slave_path_conninfo:
+            paths.append((client_id, server_id, slave_path_conninfo))
+        if stored_on_slave != master_path_conninfo:
+            paths.append((server_id, client_id, master_path_conninfo))
+
+        if not paths:
             result['changed'] = False
         else:
-            (rc, out, err) = store_path(module, cluster_name, master_conninfo, slave_conninfo, server_id, client_id)
+            (rc, out, err) = store_path(module, cluster_name, master_conninfo, slave_conninfo, server_id, client_id, paths)
             if rc != 0:
-                module.fail_json(stdout=out, msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
             result['changed'] = True
+            result['updated'] = path_is_present
 
     else:
         module.fail_json(msg="The impossible happened")
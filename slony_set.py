@@ -6,56 +6,112 @@ DOCUMENTATION = '''
 module: slony_set
 author: Alexandr Kurilin
 version_added: "1.9"
-short_description: Create / delete a slony set
+short_description: Create / delete slony sets
 requirements: [psycopg2, slonik]
 description:
     - Manage a Slony-I cluster assuming one master and one slave
+    - Either a single set given by set_id, origin_id and comment, or a list
+      of them in sets, each with its own id, origin, comment and optionally
+      state. All of them are checked against sl_set in one query and every
+      create / drop needed goes into a single slonik run.
+    - host and db are the admin conninfo of the node they belong to. Every
+      other origin of a set being created or dropped has to be listed in
+      admin_nodes, and the module fails before running slonik otherwise.
+    - Setting max_lag_events and/or max_lag_seconds makes the module wait,
+      for up to lag_timeout seconds, until the receivers involved are within
+      those limits before dropping a set, and fail otherwise
 '''
 
 EXAMPLES = '''
 # Foo
 - slony_set: name=replication
+
+- slony_set:
+    host: db1
+    db: app
+    sets:
+      - { id: 1, origin: 1, comment: accounts }
+      - { id: 2, origin: 1, comment: orders }
+      - { id: 3, origin: 2, comment: reporting }
+      - { id: 4, state: absent }
+    admin_nodes:
+      - { id: 2, host: db2, db: app }
 '''
 
-try:
-    import psycopg2
-    import psycopg2.extras
-except ImportError:
-    postgresqldb_found = False
-else:
-    postgresqldb_found = True
+from ansible.module_utils.slony.common import build_conninfo, connect, connection_kwargs, dict_cursor
+from ansible.module_utils.slony.coordination import wait_for_lag
+from ansible.module_utils.slony.slonik import fail_slonik, run_slonik, slonik_script
 
 # ===========================================
 # Postgres / slonik support methods.
 #
 
 # Don't SQL inject yourself
-def set_exists(cursor, cluster_name, set_id):
-    query = "SELECT 1 FROM _{0}.sl_set WHERE set_id = %s".format(cluster_name)
-    cursor.execute(query, (int(set_id),))
-    return cursor.rowcount == 1
-
-def create_set(module, host, db, replication_user, cluster_name, password, port, set_id, origin_id, comment):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node 1 admin conninfo='host=%s dbname=%s user=%s port=%s password=%s';
-    create set (id=%s, origin=%s, comment='%s');
-_EOF_
-    """ % (cluster_name, host, db, replication_user, port, password, set_id, origin_id, comment)
-
-    return module.run_command(cmd, use_unsafe_shell=True)
-
-def drop_set(module, host, db, replication_user, cluster_name, password, port, set_id, origin_id):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node 1 admin conninfo='host=%s dbname=%s user=%s port=%s password=%s';
-    drop set (id = %s, origin = %s);
-_EOF_
-    """ % (cluster_name, host, db, replication_user, port, password, set_id, origin_id)
-
-    return module.run_command(cmd, use_unsafe_shell=True)
+def existing_sets(cursor, cluster_name, set_ids):
+    query = "SELECT set_id, set_origin, set_comment FROM _{0}.sl_set WHERE set_id = ANY(%s)".format(cluster_name)
+    cursor.execute(query, (map(int, set_ids),))
+    return dict( (r['set_id'], r) for r in cursor.fetchall() )
+
+def local_node_id(cursor, cluster_name):
+    cursor.execute("SELECT _{0}.getLocalNodeId('_{0}')".format(cluster_name))
+    return cursor.fetchone()[0]
+
+def set_subscribers(cursor, cluster_name, set_ids):
+    query = "SELECT DISTINCT sub_receiver FROM _{0}.sl_subscribe WHERE sub_set = ANY(%s)".format(cluster_name)
+    cursor.execute(query, (map(int, set_ids),))
+    return [r[0] for r in cursor.fetchall()]
+
+# Single set parameters are the same as a one element sets list
+def wanted_sets(module):
+    params = module.params
+    if params["sets"] is None:
+        if params["set_id"] is None:
+            module.fail_json(msg="one of set_id or sets is required")
+        if params["origin_id"] is None and params["state"] == "present":
+            module.fail_json(msg="origin_id is required to create a set")
+        return [{'id': params["set_id"], 'origin': params["origin_id"],
+                 'comment': params["comment"], 'state': params["state"]}]
+
+    wanted = []
+    for entry in params["sets"]:
+        if 'id' not in entry:
+            module.fail_json(msg="every entry in sets needs an id: %s" % entry)
+        state = entry.get('state', params["state"])
+        if state not in ("absent", "present"):
+            module.fail_json(msg="state of set %s must be absent or present" % entry['id'])
+        if state == "present" and entry.get('origin') is None:
+            module.fail_json(msg="set %s needs an origin to be created" % entry['id'])
+        wanted.append({'id': entry['id'], 'origin': entry.get('origin'),
+                       'comment': entry.get('comment', ''), 'state': state})
+    return wanted
+
+# Splits the wanted sets into the ones to create and to drop, given what
+# sl_set already holds. Drops take their origin from sl_set.
+def plan_sets(module, wanted, existing):
+    to_create = []
+    to_drop = []
+    for entry in wanted:
+        current = existing.get(int(entry['id']))
+        if entry['state'] == "present":
+            if current is None:
+                to_create.append(entry)
+            elif current['set_origin'] != int(entry['origin']):
+                module.fail_json(msg="set %s already exists with origin %s, not %s"
+                                 % (entry['id'], current['set_origin'], entry['origin']))
+        elif current is not None:
+            to_drop.append({'id': entry['id'], 'origin': current['set_origin']})
+    return (to_create, to_drop)
+
+def apply_sets(module, cluster_name, admin_nodes, to_create, to_drop):
+    statements = []
+    for entry in to_drop:
+        statements.append("drop set (id = %s, origin = %s);" % (entry['id'], entry['origin']))
+    for entry in to_create:
+        statements.append("create set (id=%s, origin=%s, comment='%s');" % (entry['id'], entry['origin'], entry['comment']))
+
+    cmd = slonik_script(cluster_name, admin_nodes, statements)
+
+    return run_slonik(module, cmd)
 
 # ===========================================
 # Module execution.
@@ -68,78 +124,77 @@ def main():
             cluster_name=dict(default="replication"),
             replication_user=dict(default="postgres"),
             password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
             db=dict(required=True),
             host=dict(required=True),
-            set_id=dict(required=True),
-            origin_id=dict(required=True),
+            set_id=dict(default=None),
+            origin_id=dict(default=None),
             comment=dict(default=""),
+            sets=dict(default=None, type='list'),
+            admin_nodes=dict(default=[], type='list'),
+            max_lag_events=dict(default=None, type='int'),
+            max_lag_seconds=dict(default=None, type='int'),
+            lag_timeout=dict(default=600, type='int'),
+            slonik_retries=dict(default=5, type='int'),
+            slonik_retry_delay=dict(default=1, type='float'),
             state=dict(default="present", choices=["absent", "present"]),
         ),
         supports_check_mode = False
     )
 
-    if not postgresqldb_found:
-        module.fail_json(msg="the python psycopg2 module is required")
-
     port = module.params["port"]
     cluster_name = module.params["cluster_name"]
     replication_user = module.params["replication_user"]
     password = module.params["password"]
     db = module.params["db"]
     host = module.params["host"]
-    set_id = module.params["set_id"]
-    origin_id = module.params["set_id"]
-    comment = module.params["comment"]
-    state = module.params["state"]
-    changed = False
-
-    # To use defaults values, keyword arguments must be absent, so
-    # check which values are empty and don't include in the **kw
-    # dictionary
-    params_map = {
-        "password":"password",
-        "port":"port"
-    }
-
-    kw = dict( (params_map[k], v) for (k, v) in module.params.iteritems()
-              if k in params_map and v != '' )
+    admin_nodes = module.params["admin_nodes"]
+
+    kw = connection_kwargs(module)
 
     try:
         # TODO: this probably gets overwritten by contents of kw which can lead
         # to a total poopshow
-        db_connection_master = psycopg2.connect(
+        db_connection_master = connect(module,
                 database=db,
                 host=host,
                 user=replication_user,
                 **kw)
-        cursor = db_connection_master.cursor(
-                cursor_factory=psycopg2.extras.DictCursor)
+        cursor = dict_cursor(db_connection_master)
 
     except Exception, e:
         module.fail_json(msg="unable to connect to database: %s" % e)
 
     result = {}
 
-    if state == "absent":
-        set_is_present = set_exists(cursor, cluster_name, set_id)
-        if set_is_present:
-
-            (rc, out, err) = drop_set(module, host, db, replication_user, cluster_name, password, port, set_id, origin_id)
-            result['changed'] = True
-            if rc != 0:
-                module.fail_json(stdout=out,msg=err, rc=rc)
-        else:
-            result['changed'] = False
-
-    if state == "present":
-        set_is_present = set_exists(cursor, cluster_name, set_id)
-        if set_is_present:
-            result['changed'] = False
-        else:
-            (rc, out, err) = create_set(module, host, db, replication_user, cluster_name, password, port, set_id, origin_id, comment)
-            if rc != 0:
-                module.fail_json(stdout=out, msg=err, rc=rc)
-            result['changed'] = True
+    wanted = wanted_sets(module)
+    existing = existing_sets(cursor, cluster_name, [entry['id'] for entry in wanted])
+    (to_create, to_drop) = plan_sets(module, wanted, existing)
+
+    result['created'] = [int(entry['id']) for entry in to_create]
+    result['dropped'] = [int(entry['id']) for entry in to_drop]
+    if not to_create and not to_drop:
+        result['changed'] = False
+        module.exit_json(**result)
+
+    if to_drop:
+        wait_for_lag(module, cursor, cluster_name, set_subscribers(cursor, cluster_name, [entry['id'] for entry in to_drop]))
+
+    # every origin involved needs an admin conninfo, the only one that
+    # doesn't have to be listed is the node we are connected to
+    conninfos = dict( (int(node['id']), build_conninfo(node['host'], node['db'], replication_user, port, password))
+                      for node in admin_nodes )
+    local_id = local_node_id(cursor, cluster_name)
+    conninfos.setdefault(local_id, build_conninfo(host, db, replication_user, port, password))
+    for entry in to_create + to_drop:
+        if int(entry['origin']) not in conninfos:
+            module.fail_json(msg="set %s has origin %s, which is not in admin_nodes and is not the node %s/%s is (node %s)"
+                             % (entry['id'], entry['origin'], host, db, local_id))
+
+    (rc, out, err) = apply_sets(module, cluster_name, sorted(conninfos.items()), to_create, to_drop)
+    if rc != 0:
+        fail_slonik(module, rc, out, err)
+    result['changed'] = True
 
     module.exit_json(**result)
 
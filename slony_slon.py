@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = '''
+---
+module: slony_slon
+author: Alexandr Kurilin
+version_added: "1.9"
+short_description: Render the runtime configuration of a slon daemon
+requirements: []
+description:
+    - Writes the slon configuration file for one node of a Slony-I cluster,
+      built from the same connection parameters slony_node takes, and
+      validates the tuning settings against the ranges slon accepts
+    - slon only reads its configuration file at startup, so the module reports
+      which settings changed and whether the daemon needs a restart to pick
+      them up
+    - Setting archive_dir turns the slon into a log shipping archiver, writing
+      every SYNC it applies to a file in that directory for slony_archive to
+      apply on an offline node. The directory is created if it's missing.
+    - The file holds the replication password. Unless mode is given, a new
+      file is only readable by its owner, so set owner (and group) to the
+      user slon runs as. owner, group and mode take the usual file module
+      values and a change to them alone is reported as changed.
+'''
+
+EXAMPLES = '''
+- slony_slon: node_id=2 host=db2 db=app dest=/etc/slony1/slon_node2.conf owner=postgres sync_group_maxsize=50 desired_sync_time=60000
+  notify: restart slon
+
+# Ship node 2's SYNCs to a WAN replica
+- slony_slon: node_id=2 host=db2 db=app dest=/etc/slony1/slon_node2.conf archive_dir=/var/lib/slony1/archive
+'''
+
+import os
+import tempfile
+
+from ansible.module_utils.slony.common import build_conninfo
+
+# name -> (type, minimum, maximum), as documented for slon 2.2. None means
+# the value isn't range checked.
+SLON_SETTINGS = {
+    "log_level":             ("int", -1, 4),
+    "sync_interval":         ("int", 10, 60000),
+    "sync_interval_timeout": ("int", 0, 1200000),
+    "sync_group_maxsize":    ("int", 0, 10000),
+    "desired_sync_time":     ("int", 0, 600000),
+    "remote_listen_timeout": ("int", 30, 30000),
+    "vac_frequency":         ("int", 0, 100),
+    "lag_interval":          ("string", None, None),
+    "cleanup_interval":      ("string", None, None),
+    "cleanup_deletelogs":    ("bool", None, None),
+    "pid_file":              ("string", None, None),
+    "archive_dir":           ("string", None, None),
+    "sql_on_connection":     ("string", None, None),
+}
+
+# ===========================================
+# slon configuration support methods.
+#
+
+def validate_settings(settings):
+    errors = []
+    for (name, value) in sorted(settings.items()):
+        (kind, low, high) = SLON_SETTINGS[name]
+        if kind == "int" and (value < low or value > high):
+            errors.append("%s must be between %s and %s, got %s" % (name, low, high, value))
+    # 0 turns the adaptive SYNC grouping off, anything else under 10s is
+    # rejected by slon at startup
+    desired = settings.get("desired_sync_time")
+    if desired is not None and 0 < desired < 10000:
+        errors.append("desired_sync_time must be 0 or at least 10000, got %s" % desired)
+    return errors
+
+def format_value(kind, value):
+    if kind == "int":
+        return str(value)
+    if kind == "bool":
+        if value:
+            return "true"
+        return "false"
+    return "'%s'" % str(value).replace("'", "\\'")
+
+def render_config(cluster_name, conninfo, settings):
+    lines = [
+        "# Managed by Ansible, local changes will be overwritten",
+        "cluster_name=%s" % format_value("string", cluster_name),
+        "conn_info=%s" % format_value("string", conninfo),
+    ]
+    for name in sorted(settings):
+        lines.append("%s=%s" % (name, format_value(SLON_SETTINGS[name][0], settings[name])))
+    return "\n".join(lines) + "\n"
+
+def parse_config(content):
+    values = {}
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#") or "=" not in line:
+            continue
+        (key, value) = line.split("=", 1)
+        values[key.strip()] = value.strip()
+    return values
+
+def changed_settings(old_content, new_content):
+    old = parse_config(old_content)
+    new = parse_config(new_content)
+    return sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+
+def write_config(module, dest, content):
+    # atomic_move gives a file it creates the umask's permissions, so a new
+    # one is created private first and the password never sits in the open
+    if not os.path.exists(dest):
+        os.close(os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600))
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(dest) or ".")
+    f = os.fdopen(fd, "w")
+    try:
+        f.write(content)
+    finally:
+        f.close()
+    module.atomic_move(tmp_path, dest)
+
+# ===========================================
+# Module execution.
+#
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            port=dict(default="5432"),
+            cluster_name=dict(default="replication"),
+            replication_user=dict(default="postgres"),
+            password=dict(default=""),
+            db=dict(required=True),
+            host=dict(required=True),
+            node_id=dict(required=True),
+            dest=dict(required=True),
+            log_level=dict(default=None, type='int'),
+            sync_interval=dict(default=None, type='int'),
+            sync_interval_timeout=dict(default=None, type='int'),
+            sync_group_maxsize=dict(default=None, type='int'),
+            desired_sync_time=dict(default=None, type='int'),
+            remote_listen_timeout=dict(default=None, type='int'),
+            vac_frequency=dict(default=None, type='int'),
+            lag_interval=dict(default=None),
+            cleanup_interval=dict(default=None),
+            cleanup_deletelogs=dict(default=None, type='bool'),
+            pid_file=dict(default=None),
+            archive_dir=dict(default=None),
+            sql_on_connection=dict(default=None),
+        ),
+        add_file_common_args = True,
+        supports_check_mode = True
+    )
+
+    port = module.params["port"]
+    cluster_name = module.params["cluster_name"]
+    replication_user = module.params["replication_user"]
+    password = module.params["password"]
+    db = module.params["db"]
+    host = module.params["host"]
+    node_id = module.params["node_id"]
+    dest = module.params["dest"]
+
+    conninfo = build_conninfo(host, db, replication_user, port, password)
+
+    # Only settings that were asked for end up in the file, everything else
+    # keeps slon's built in default
+    settings = dict( (k, module.params[k]) for k in SLON_SETTINGS
+                     if module.params[k] is not None )
+
+    errors = validate_settings(settings)
+    if errors:
+        module.fail_json(msg="invalid slon settings for node %s: %s" % (node_id, "; ".join(errors)))
+
+    content = render_config(cluster_name, conninfo, settings)
+
+    if os.path.exists(dest):
+        f = open(dest)
+        try:
+            old_content = f.read()
+        finally:
+            f.close()
+    else:
+        old_content = None
+
+    result = {}
+    result['dest'] = dest
+    result['node_id'] = node_id
+
+    if old_content == content:
+        result['changed_settings'] = []
+    elif old_content is None:
+        result['changed_settings'] = sorted(parse_config(content))
+    else:
+        result['changed_settings'] = changed_settings(old_content, content)
+
+    # slon doesn't reload its config file, every real change needs a restart.
+    # A freshly written file has no daemon running off it yet.
+    result['restart_required'] = old_content is not None and len(result['changed_settings']) > 0
+    changed = old_content != content
+
+    if changed and not module.check_mode:
+        try:
+            if settings.get("archive_dir") and not os.path.isdir(settings["archive_dir"]):
+                os.makedirs(settings["archive_dir"], 0750)
+            write_config(module, dest, content)
+        except (IOError, OSError), e:
+            module.fail_json(msg="unable to write %s: %s" % (dest, e))
+
+    # the password is in there, a new file stays private unless asked otherwise
+    file_args = module.load_file_common_arguments(module.params)
+    if file_args['mode'] is None and old_content is None:
+        file_args['mode'] = 0600
+    if os.path.exists(dest):
+        changed = module.set_fs_attributes_if_different(file_args, changed)
+    result['changed'] = changed
+
+    module.exit_json(**result)
+
+from ansible.module_utils.basic import *
+main()
@@ -10,20 +10,55 @@ short_description: Create / delete a slony subscription
 requirements: [psycopg2, slonik]
 description:
     - Manage a Slony-I subscription
+    - With omit_copy the receiver is assumed to already hold the set's data,
+      for example restored from a physical or parallel pg_dump backup, and
+      the initial COPY is skipped. The set's tables and their row estimates
+      are compared between provider and receiver before subscribing.
+    - With copy_stages greater than one, the first subscription of a set
+      spreads its tables over that many temporary sets of roughly equal size,
+      subscribes all of them and merges them back into the set. The receiver's
+      slon still copies sets of one origin one after another, so this does
+      not copy in parallel. It splits the initial copy into stages that
+      complete on their own, so a copy that fails late only redoes the stage
+      it failed in rather than the whole set.
+    - The tables are moved into the temporary sets in a single transaction on
+      the origin. If the run fails after that, the next run finds the
+      temporary sets by their comment and finishes subscribing and merging
+      them instead of starting over.
+    - Setting max_lag_events and/or max_lag_seconds makes the module wait,
+      for up to lag_timeout seconds, until the receivers involved are within
+      those limits before unsubscribing, and fail otherwise
+    - Runs against the same cluster_name are serialized with an advisory
+      lock on the cluster's lowest numbered node, waited on for up to
+      lock_timeout seconds. When that node is not the provider, the receiver
+      or the origin given by origin_host / origin_db, lock_host and lock_db
+      have to name its database.
+    - When the receiver already subscribes to the set through a different
+      provider, it is moved to provider_id with RESUBSCRIBE NODE rather than
+      being unsubscribed and copied again. RESUBSCRIBE NODE moves every set
+      of the set's origin that the receiver subscribes to. The event is
+      submitted on the origin, so when the origin isn't provider_id its
+      origin_host and origin_db must be given.
 '''
 
 EXAMPLES = '''
 # Foo
 - slony_subscription: name=TODO
+
+# Receiver restored from a backup of the provider
+- slony_subscription: master_host=db1 slave_host=db2 master_db=app slave_db=app set_id=1 provider_id=1 receiver_id=2 omit_copy=yes
+
+# Move node 3 from the origin to the cascaded provider on node 2
+- slony_subscription: origin_host=db1 origin_db=app master_host=db2 slave_host=db3 master_db=app slave_db=app set_id=1 provider_id=2 receiver_id=3
+
+# Initial copy of a set with a few very large tables
+- slony_subscription: master_host=db1 slave_host=db2 master_db=app slave_db=app set_id=1 provider_id=1 receiver_id=3 copy_stages=4
 '''
 
-try:
-    import psycopg2
-    import psycopg2.extras
-except ImportError:
-    postgresqldb_found = False
-else:
-    postgresqldb_found = True
+from ansible.module_utils.slony.common import balance_buckets, build_conninfo, connect, dict_cursor, set_origin
+from ansible.module_utils.slony.coordination import cluster_lock_cursor, lock_cluster, wait_for_lag
+from ansible.module_utils.slony.preseed import relation_estimates, set_table_estimates, verify_preseeded
+from ansible.module_utils.slony.slonik import ALREADY_ABSENT, fail_slonik, run_slonik, slonik_script
 
 # ===========================================
 # Postgres / slonik support methods.
@@ -38,37 +73,118 @@ def subscription_exists(cursor, cluster_name, set_id, provider_id, receiver_id):
     cursor.execute(query, (int(set_id), int(provider_id), int(receiver_id)))
     return cursor.rowcount == 1
 
+# Provider the receiver currently gets the set from, if it subscribes to it
+def subscription_provider(cursor, cluster_name, set_id, receiver_id):
+    query = """SELECT sub_provider FROM _{0}.sl_subscribe
+               WHERE sub_set = %s
+               AND sub_receiver = %s
+               """.format(cluster_name)
+    cursor.execute(query, (int(set_id), int(receiver_id)))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+def set_has_subscribers(cursor, cluster_name, set_id):
+    query = "SELECT 1 FROM _{0}.sl_subscribe WHERE sub_set = %s".format(cluster_name)
+    cursor.execute(query, (int(set_id),))
+    return cursor.rowcount > 0
+
+def existing_set_ids(cursor, cluster_name, set_ids):
+    query = "SELECT set_id FROM _{0}.sl_set WHERE set_id = ANY(%s)".format(cluster_name)
+    cursor.execute(query, (map(int, set_ids),))
+    return [r[0] for r in cursor.fetchall()]
+
+def set_table_sizes(cursor, cluster_name, set_id):
+    query = """SELECT tab_id, tab_nspname, tab_relname, tab_idxname, tab_comment,
+                      pg_catalog.pg_total_relation_size(tab_reloid) AS size
+               FROM _{0}.sl_table
+               WHERE tab_set = %s""".format(cluster_name)
+    cursor.execute(query, (int(set_id),))
+    return cursor.fetchall()
+
+STAGE_SET_COMMENT = "temporary copy stage %s of set %s"
+
+# Temporary sets left behind by a staged subscription of set_id that didn't
+# get merged back
+def stage_sets(cursor, cluster_name, set_id):
+    query = """SELECT set_id FROM _{0}.sl_set
+               WHERE set_comment LIKE %s
+               ORDER BY set_id""".format(cluster_name)
+    cursor.execute(query, (STAGE_SET_COMMENT % ("%", int(set_id)),))
+    return [r[0] for r in cursor.fetchall()]
+
+def receiver_sets(cursor, cluster_name, receiver_id, set_ids):
+    query = "SELECT sub_set FROM _{0}.sl_subscribe WHERE sub_receiver = %s AND sub_set = ANY(%s)".format(cluster_name)
+    cursor.execute(query, (int(receiver_id), map(int, set_ids)))
+    return frozenset(r[0] for r in cursor.fetchall())
+
 # defaults FORWARD to YES
-def subscribe_set(module, cluster_name, master_conninfo, slave_conninfo, set_id, provider_id, receiver_id):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node %s admin conninfo='%s';
-    node %s admin conninfo='%s';
-    subscribe set (id=%s, provider=%s, receiver=%s, forward=YES);
-_EOF_
-    """ % (cluster_name,
-           provider_id, master_conninfo,
-           receiver_id, slave_conninfo,
-           set_id, provider_id, receiver_id,
-           )
-
-    return module.run_command(cmd, use_unsafe_shell=True)
+def subscribe_set(module, cluster_name, master_conninfo, slave_conninfo, set_id, provider_id, receiver_id, omit_copy=False):
+    if omit_copy:
+        omit_copy_option = ", omit copy=YES"
+    else:
+        omit_copy_option = ""
+    cmd = slonik_script(cluster_name,
+                        [(provider_id, master_conninfo), (receiver_id, slave_conninfo)],
+                        ["subscribe set (id=%s, provider=%s, receiver=%s, forward=YES%s);" % (set_id, provider_id, receiver_id, omit_copy_option)])
+
+    return run_slonik(module, cmd)
+
+# Moves the set's tables into temporary sets. Only safe while nobody
+# subscribes to the set yet, as the tables leave it. The try block makes it
+# a single transaction on the origin, so either every table has moved or
+# none has.
+def stage_tables(module, cluster_name, master_conninfo, slave_conninfo, set_id, origin_id, provider_id, receiver_id, buckets, temp_set_id):
+    statements = ["try {"]
+    for bucket in buckets:
+        for table in bucket:
+            statements.append("    set drop table (origin=%s, id=%s);" % (origin_id, table['tab_id']))
+    for (i, bucket) in enumerate(buckets):
+        statements.append("    create set (id=%s, origin=%s, comment='%s');"
+                          % (temp_set_id + i, origin_id, STAGE_SET_COMMENT % (i + 1, set_id)))
+        for table in bucket:
+            statements.append("    set add table (set id=%s, origin=%s, id=%s, fully qualified name = '%s.%s', key = '%s', comment='%s');"
+                              % (temp_set_id + i, origin_id, table['tab_id'],
+                                 table['tab_nspname'], table['tab_relname'], table['tab_idxname'], table['tab_comment'] or ''))
+    statements.extend(["}", "on error {", "    exit 1;", "}"])
+
+    cmd = slonik_script(cluster_name,
+                        [(provider_id, master_conninfo), (receiver_id, slave_conninfo)],
+                        statements)
+
+    return run_slonik(module, cmd)
+
+# Subscribes the receiver to the set and the temporary sets, skipping those
+# it already subscribes to, then merges the temporary sets back in
+def merge_stage_sets(module, cluster_name, master_conninfo, slave_conninfo, set_id, origin_id, provider_id, receiver_id, temp_set_ids, subscribed):
+    statements = []
+    for sid in [int(set_id)] + list(temp_set_ids):
+        if sid not in subscribed:
+            statements.append("subscribe set (id=%s, provider=%s, receiver=%s, forward=YES);" % (sid, provider_id, receiver_id))
+    for sid in temp_set_ids:
+        statements.append("merge set (id=%s, add id=%s, origin=%s);" % (set_id, sid, origin_id))
+
+    cmd = slonik_script(cluster_name,
+                        [(provider_id, master_conninfo), (receiver_id, slave_conninfo)],
+                        statements)
+
+    return run_slonik(module, cmd)
+
+# Repoints the receiver at a new provider without dropping its data
+def resubscribe_node(module, cluster_name, origin_conninfo, master_conninfo, slave_conninfo, origin_id, provider_id, receiver_id):
+    admin_nodes = [(provider_id, master_conninfo), (receiver_id, slave_conninfo)]
+    if int(origin_id) != int(provider_id):
+        admin_nodes.append((origin_id, origin_conninfo))
+    cmd = slonik_script(cluster_name, admin_nodes,
+                        ["resubscribe node (origin=%s, provider=%s, receiver=%s);" % (origin_id, provider_id, receiver_id)])
+    return run_slonik(module, cmd)
 
 def unsubscribe_set(module, cluster_name, master_conninfo, slave_conninfo, set_id, provider_id, receiver_id):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node %s admin conninfo='%s';
-    node %s admin conninfo='%s';
-    unsubscribe set (id=%s, receiver=%s);
-_EOF_
-    """ % (cluster_name,
-           provider_id, master_conninfo,
-           receiver_id, slave_conninfo,
-           set_id, receiver_id,
-           )
-    return module.run_command(cmd, use_unsafe_shell=True)
+    cmd = slonik_script(cluster_name,
+                        [(provider_id, master_conninfo), (receiver_id, slave_conninfo)],
+                        ["unsubscribe set (id=%s, receiver=%s);" % (set_id, receiver_id)])
+    return run_slonik(module, cmd, done=ALREADY_ABSENT)
 
 # ===========================================
 # Module execution.
@@ -81,21 +197,33 @@ def main():
             cluster_name=dict(default="replication"),
             replication_user=dict(default="postgres"),
             password=dict(default=""),
+            agent_socket=dict(default="~/.ansible/slony_agent.sock"),
             master_db=dict(required=True),
             slave_db=dict(required=True),
             master_host=dict(required=True),
             slave_host=dict(required=True),
+            origin_db=dict(default=None),
+            origin_host=dict(default=None),
             set_id=dict(required=True),
             provider_id=dict(required=True),
             receiver_id=dict(required=True),
+            omit_copy=dict(default=False, type='bool'),
+            omit_copy_tolerance=dict(default=10, type='int'),
+            copy_stages=dict(default=1, type='int'),
+            temp_set_id=dict(default=1000, type='int'),
+            max_lag_events=dict(default=None, type='int'),
+            max_lag_seconds=dict(default=None, type='int'),
+            lag_timeout=dict(default=600, type='int'),
+            lock_timeout=dict(default=300, type='int'),
+            lock_host=dict(default=None),
+            lock_db=dict(default=None),
+            slonik_retries=dict(default=5, type='int'),
+            slonik_retry_delay=dict(default=1, type='float'),
             state=dict(default="present", choices=["absent", "present"]),
         ),
         supports_check_mode = False
     )
 
-    if not postgresqldb_found:
-        module.fail_json(msg="the python psycopg2 module is required")
-
     port = module.params["port"]
     cluster_name = module.params["cluster_name"]
     replication_user = module.params["replication_user"]
@@ -104,56 +232,124 @@ def main():
     slave_db = module.params["slave_db"]
     master_host = module.params["master_host"]
     slave_host = module.params["slave_host"]
+    origin_db = module.params["origin_db"]
+    origin_host = module.params["origin_host"]
     set_id = module.params["set_id"]
     provider_id = module.params["provider_id"]
     receiver_id = module.params["receiver_id"]
+    omit_copy = module.params["omit_copy"]
+    omit_copy_tolerance = module.params["omit_copy_tolerance"]
+    copy_stages = module.params["copy_stages"]
+    temp_set_id = module.params["temp_set_id"]
     state = module.params["state"]
     changed = False
 
-    master_conninfo = "host=%s dbname=%s user=%s port=%s password=%s" % (master_host, master_db, replication_user, port, password)
-    slave_conninfo = "host=%s dbname=%s user=%s port=%s password=%s" % (slave_host, slave_db, replication_user, port, password)
-
-    # To use defaults values, keyword arguments must be absent, so
-    # check which values are empty and don't include in the **kw
-    # dictionary
-    params_map = {
-        "password":"password",
-        "port":"port"
-    }
-
-    kw = dict( (params_map[k], v) for (k, v) in module.params.iteritems()
-              if k in params_map and v != '' )
+    master_conninfo = build_conninfo(master_host, master_db, replication_user, port, password)
+    slave_conninfo = build_conninfo(slave_host, slave_db, replication_user, port, password)
 
     try:
-        db_connection_master = psycopg2.connect(master_conninfo)
-        db_connection_slave = psycopg2.connect(slave_conninfo)
+        db_connection_master = connect(module, master_conninfo)
+        db_connection_slave = connect(module, slave_conninfo)
         db_connection_master.set_isolation_level(0)
         db_connection_slave.set_isolation_level(0)
-        master_cursor = db_connection_master.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        slave_cursor = db_connection_slave.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        master_cursor = dict_cursor(db_connection_master)
+        slave_cursor = dict_cursor(db_connection_slave)
     except Exception, e:
         module.fail_json(msg="unable to connect to database: %s" % e)
 
+    if copy_stages < 1:
+        module.fail_json(msg="copy_stages must be at least 1")
+    if omit_copy and copy_stages > 1:
+        module.fail_json(msg="omit_copy and copy_stages are mutually exclusive, there is nothing to copy")
+
+    lock_nodes = [(provider_id, master_host, master_db), (receiver_id, slave_host, slave_db)]
+    if origin_host and origin_db:
+        lock_nodes.append((set_origin(master_cursor, cluster_name, set_id), origin_host, origin_db))
+    lock_cursor = cluster_lock_cursor(module, master_cursor, cluster_name, lock_nodes)
+    lock_cluster(module, lock_cursor, cluster_name)
+
     result = {}
 
     sub_is_present = subscription_exists(master_cursor, cluster_name, set_id, provider_id, receiver_id)
 
     if state == "absent":
         if sub_is_present:
+            wait_for_lag(module, master_cursor, cluster_name, [receiver_id])
             (rc, out, err) = unsubscribe_set(module, cluster_name, master_conninfo, slave_conninfo, set_id, provider_id, receiver_id)
             result['changed'] = True
             if rc != 0:
-                module.fail_json(stdout=out,msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
         else:
             result['changed'] = False
 
     elif state == "present":
-        if sub_is_present:
+        current_provider = None
+        if not sub_is_present:
+            current_provider = subscription_provider(master_cursor, cluster_name, set_id, receiver_id)
+        leftover_sets = stage_sets(master_cursor, cluster_name, set_id)
+
+        if leftover_sets:
+            # an earlier staged subscription got as far as moving the tables
+            origin_id = set_origin(master_cursor, cluster_name, set_id)
+            subscribed = receiver_sets(master_cursor, cluster_name, receiver_id, [set_id] + leftover_sets)
+            (rc, out, err) = merge_stage_sets(module, cluster_name, master_conninfo, slave_conninfo, set_id, origin_id, provider_id, receiver_id, leftover_sets, subscribed)
+            if rc != 0:
+                fail_slonik(module, rc, out, err, msg="resuming the staged subscription of set %s failed" % set_id)
+            result['changed'] = True
+            result['resumed_copy_stages'] = leftover_sets
+        elif sub_is_present:
             result['changed'] = False
+        elif current_provider is not None:
+            origin_id = set_origin(master_cursor, cluster_name, set_id)
+            origin_conninfo = None
+            if origin_id != int(provider_id):
+                if not origin_host or not origin_db:
+                    module.fail_json(msg="set %s is subscribed through node %s, moving it to node %s needs origin_host and origin_db of origin node %s"
+                                     % (set_id, current_provider, provider_id, origin_id))
+                origin_conninfo = build_conninfo(origin_host, origin_db, replication_user, port, password)
+            (rc, out, err) = resubscribe_node(module, cluster_name, origin_conninfo, master_conninfo, slave_conninfo, origin_id, provider_id, receiver_id)
+            if rc != 0:
+                fail_slonik(module, rc, out, err)
+            result['changed'] = True
+            result['previous_provider'] = current_provider
         else:
-            (rc, out, err) = subscribe_set(module, cluster_name, master_conninfo, slave_conninfo, set_id, provider_id, receiver_id)
+            if omit_copy:
+                # reltuples is an estimate, so small drift between two copies
+                # of the same data is expected; a missing table is not
+                provider_estimates = set_table_estimates(master_cursor, cluster_name, set_id)
+                receiver_estimates = relation_estimates(slave_cursor, provider_estimates.keys())
+                problems = verify_preseeded(provider_estimates, receiver_estimates, omit_copy_tolerance)
+                if problems:
+                    module.fail_json(msg="receiver does not match the provider, refusing to omit copy: %s" % "; ".join(problems))
+
+            # Splitting only pays off for the initial copy off the origin; a
+            # set that already has subscribers can't have its tables moved
+            # around, and the temporary sets only exist on the origin
+            origin_id = set_origin(master_cursor, cluster_name, set_id)
+            staged = (copy_stages > 1
+                      and origin_id == int(provider_id)
+                      and not set_has_subscribers(master_cursor, cluster_name, set_id))
+            if staged:
+                buckets = balance_buckets(set_table_sizes(master_cursor, cluster_name, set_id), copy_stages, lambda t: t['size'])
+                staged = len(buckets) > 1
+
+            if staged:
+                taken = existing_set_ids(master_cursor, cluster_name, range(temp_set_id, temp_set_id + len(buckets)))
+                if taken:
+                    module.fail_json(msg="temporary set ids %s are already in use, pick another temp_set_id" % taken)
+                result['copy_stages'] = [[t['tab_id'] for t in b] for b in buckets]
+                (rc, out, err) = stage_tables(module, cluster_name, master_conninfo, slave_conninfo, set_id, origin_id, provider_id, receiver_id, buckets, temp_set_id)
+                if rc != 0:
+                    fail_slonik(module, rc, out, err)
+                temp_set_ids = range(temp_set_id, temp_set_id + len(buckets))
+                (rc, out, err) = merge_stage_sets(module, cluster_name, master_conninfo, slave_conninfo, set_id, origin_id, provider_id, receiver_id, temp_set_ids, frozenset())
+                if rc != 0:
+                    fail_slonik(module, rc, out, err, msg="the tables of set %s are in temporary sets %s, run again to finish subscribing"
+                                % (set_id, temp_set_ids))
+            else:
+                (rc, out, err) = subscribe_set(module, cluster_name, master_conninfo, slave_conninfo, set_id, provider_id, receiver_id, omit_copy)
             if rc != 0:
-                module.fail_json(stdout=out, msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
             result['changed'] = True
 
     else:
@@ -7,122 +7,156 @@ module: slony_table
 author: Alexandr Kurilin
 version_added: "1.9"
 short_description: Add or drop tables and sequences from/to a slony replication set
-requirements: [psycopg2, slonik, jinja2]
+requirements: [psycopg2, slonik]
 description:
     - Adds or removes Slony-I tables and sequences in a replication set
+    - tables and sequences are the complete contents of the set, anything
+      else in it is dropped. Leaving sequences out means the set has none.
+    - Setting max_lag_events and/or max_lag_seconds makes the module wait,
+      for up to lag_timeout seconds, until the receivers involved are within
+      those limits before merging new tables into a subscribed set, and fail
+      otherwise
+    - Each entry of tables may carry a key, the unique index slony
+      replicates the table by, for tables without a primary key
+    - Table ids listed in resync are taken out of the set, added to a
+      temporary set that receiver_id subscribes to, which copies just those
+      tables again, and merged back, all in one slonik run. This is only
+      done when receiver_id is the set's one subscriber, as every
+      subscriber would otherwise have to recopy them. The tables keep the
+      key they were replicated by. As this recopies them on every run, it
+      is only done with force_resync=yes, and fails otherwise.
+    - New tables and resynced ones pass through temporary set 99. When a run
+      fails halfway and leaves set 99 behind holding tables and sequences of
+      this set, the next run subscribes and merges it before anything else.
+      A set 99 holding anything else is left alone and fails the run.
+    - Runs against the same cluster_name are serialized with an advisory
+      lock on the cluster's lowest numbered node, waited on for up to
+      lock_timeout seconds. When that node is neither the origin nor the
+      receiver, lock_host and lock_db have to name its database.
 '''
 
 EXAMPLES = '''
 # Foo
 - slony_table: name=TODO
-'''
 
-import jinja2
+# Recopy table 12 on node 2 without resubscribing the whole set
+- slony_table:
+    master_host: db1
+    master_db: app
+    slave_host: db2
+    slave_db: app
+    set_id: 1
+    origin_id: 1
+    receiver_id: 2
+    tables: "{{ replicated_tables }}"
+    resync: [12]
+    force_resync: yes
+'''
 
-try:
-    import psycopg2
-    import psycopg2.extras
-except ImportError:
-    postgresqldb_found = False
-else:
-    postgresqldb_found = True
+from ansible.module_utils.slony.common import build_conninfo, connect, dict_cursor, replicated_sequences, replicated_tables, set_origin
+from ansible.module_utils.slony.coordination import cluster_lock_cursor, lock_cluster, wait_for_lag
+from ansible.module_utils.slony.slonik import ALREADY_ABSENT, ALREADY_PRESENT, fail_slonik, run_slonik, slonik_script
 
 # ===========================================
 # Postgres / slonik support methods.
 #
 
+# Id of the set new and resynced tables are copied through on their way into
+# the set
+TEMP_SET_ID = 99
+
 def set_is_subscribed(cursor, cluster_name, set_id):
     query = "SELECT 1 FROM _{0}.sl_subscribe WHERE sub_set = %s".format(cluster_name)
     cursor.execute(query, (int(set_id),))
     return cursor.rowcount == 1
 
-def replicated_tables(cursor, cluster_name, set_id):
-    query = """SELECT tab_id,tab_relname,tab_nspname,tab_set
-               FROM _{0}.sl_table
-               WHERE tab_set = %s""".format(cluster_name)
+def set_subscribers(cursor, cluster_name, set_id):
+    query = "SELECT sub_receiver FROM _{0}.sl_subscribe WHERE sub_set = %s".format(cluster_name)
     cursor.execute(query, (int(set_id),))
-    return cursor.fetchall()
+    return [r[0] for r in cursor.fetchall()]
 
-def replicated_sequences(cursor, cluster_name, set_id):
-    query = """SELECT seq_id,seq_relname,seq_nspname,seq_set
-               FROM _{0}.sl_sequence
-               WHERE seq_set = %s""".format(cluster_name)
-    cursor.execute(query, (int(set_id),))
-    return cursor.fetchall()
+# The key clause of set add table for tables replicated by an index other
+# than their primary key
+def key_option(table):
+    if table.get('key'):
+        return ", key = '%s'" % table['key']
+    return ""
 
-def create_table(module, host, db, replication_user, cluster_name, password, port, set_id, origin_id, table_id, fqname, comment):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node 1 admin conninfo='host=%s dbname=%s user=%s port=%s password=%s';
-    set add table (set id=%s, origin=%s, id=%s, fully qualified name = '%s', comment='%s');
-_EOF_
-    """ % (cluster_name, host, db, replication_user, port, password, set_id, origin_id, table_id, fqname, comment)
+def create_table(module, host, db, replication_user, cluster_name, password, port, set_id, origin_id, table):
+    cmd = slonik_script(cluster_name,
+                        [(1, build_conninfo(host, db, replication_user, port, password))],
+                        ["set add table (set id=%s, origin=%s, id=%s, fully qualified name = '%s', comment='%s'%s);"
+                         % (set_id, origin_id, table['id'], table['fqname'], table.setdefault('comment', ''), key_option(table))])
 
-    return module.run_command(cmd, use_unsafe_shell=True)
+    return run_slonik(module, cmd, done=ALREADY_PRESENT)
 
 def drop_table(module, host, db, replication_user, cluster_name, password, port, origin_id, table_id):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node 1 admin conninfo='host=%s dbname=%s user=%s port=%s password=%s';
-    set drop table (origin=%s, id=%s);
-_EOF_
-    """ % (cluster_name, host, db, replication_user, port, password, origin_id, table_id)
+    cmd = slonik_script(cluster_name,
+                        [(1, build_conninfo(host, db, replication_user, port, password))],
+                        ["set drop table (origin=%s, id=%s);" % (origin_id, table_id)])
 
-    return module.run_command(cmd, use_unsafe_shell=True)
+    return run_slonik(module, cmd, done=ALREADY_ABSENT)
 
 def create_sequence(module, host, db, replication_user, cluster_name, password, port, set_id, origin_id, sequence_id, fqname, comment):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node 1 admin conninfo='host=%s dbname=%s user=%s port=%s password=%s';
-    set add sequence (set id=%s, origin=%s, id=%s, fully qualified name='%s', comment='%s');
-_EOF_
-    """ % (cluster_name, host, db, replication_user, port, password, set_id, origin_id, sequence_id, fqname, comment)
+    cmd = slonik_script(cluster_name,
+                        [(1, build_conninfo(host, db, replication_user, port, password))],
+                        ["set add sequence (set id=%s, origin=%s, id=%s, fully qualified name='%s', comment='%s');" % (set_id, origin_id, sequence_id, fqname, comment)])
 
-    return module.run_command(cmd, use_unsafe_shell=True)
+    return run_slonik(module, cmd, done=ALREADY_PRESENT)
 
 def drop_sequence(module, host, db, replication_user, cluster_name, password, port, origin_id, sequence_id):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = %s;
-    node 1 admin conninfo='host=%s dbname=%s user=%s port=%s password=%s';
-    set drop sequence (origin=%s, id=%s);
-_EOF_
-    """ % (cluster_name, host, db, replication_user, port, password, origin_id, sequence_id)
-
-    return module.run_command(cmd, use_unsafe_shell=True)
+    cmd = slonik_script(cluster_name,
+                        [(1, build_conninfo(host, db, replication_user, port, password))],
+                        ["set drop sequence (origin=%s, id=%s);" % (origin_id, sequence_id)])
+
+    return run_slonik(module, cmd, done=ALREADY_ABSENT)
+
+# Statements that move tables and sequences into the set through temporary
+# set 99, which gets them copied to the receiver on the way
+def merge_statements(set_id, origin_id, provider_id, receiver_id, new_tables, new_sequences):
+    statements = ["create set (id = %s, origin = %s, comment='temporary replication set to be merged');" % (TEMP_SET_ID, origin_id)]
+    for sequence in new_sequences:
+        statements.append("set add sequence (set id=%s, origin=%s, id=%s, fully qualified name = '%s', comment='%s');"
+                          % (TEMP_SET_ID, origin_id, sequence['id'], sequence['fqname'], sequence.get('comment', '')))
+    for table in new_tables:
+        statements.append("set add table (set id=%s, origin=%s, id=%s, fully qualified name = '%s', comment='%s'%s);"
+                          % (TEMP_SET_ID, origin_id, table['id'], table['fqname'], table.get('comment', ''), key_option(table)))
+    statements.append("subscribe set(id=%s, provider=%s, receiver=%s);" % (TEMP_SET_ID, provider_id, receiver_id))
+    statements.append("merge set(id=%s, add id=%s, origin=%s);" % (set_id, TEMP_SET_ID, origin_id))
+    return statements
 
 # merge new tables tables and sequences into existing replication set
 def merge_tables_seqs(module, master_conninfo, slave_conninfo, cluster_name, set_id, origin_id, provider_id, receiver_id, new_tables, new_sequences):
-    cmd = """
-    slonik <<_EOF_
-    cluster name = {{ cluster_name }};
-    node {{ origin_id }} admin conninfo='{{ master_conninfo }}';
-    node {{ receiver_id }} admin conninfo='{{ slave_conninfo }}';
-    create set (id = 99, origin = {{ origin_id }}, comment='temporary replication set to be merged');
-    {% for sequence in sequences %}
-    set add sequence (set id=99, origin={{ origin_id }}, id={{ sequence.id }}, fully qualified name = '{{ sequence.fqname }}', comment='{{ sequence.comment }}');
-    {% endfor %}
-    {% for table in tables %}
-    set add table (set id=99, origin={{ origin_id }}, id={{ table.id }}, fully qualified name = '{{ table.fqname }}', comment='{{ table.comment }}');
-    {% endfor %}
-    subscribe set(id=99, provider={{ provider_id }}, receiver={{ receiver_id }});
-    merge set(id={{ set_id }}, add id=99, origin={{ origin_id }});
-_EOF_"""
-    template = jinja2.Template(cmd)
-    rendered = template.render(cluster_name=cluster_name,
-                               master_conninfo=master_conninfo,
-                               slave_conninfo=slave_conninfo,
-                               origin_id=origin_id,
-                               provider_id=provider_id,
-                               receiver_id=receiver_id,
-                               set_id=set_id,
-                               sequences=new_sequences,
-                               tables=new_tables)
-    return module.run_command(rendered, use_unsafe_shell=True)
-
+    cmd = slonik_script(cluster_name,
+                        [(origin_id, master_conninfo), (receiver_id, slave_conninfo)],
+                        merge_statements(set_id, origin_id, provider_id, receiver_id, new_tables, new_sequences))
+    return run_slonik(module, cmd)
+
+# Finishes what an earlier merge or resync left in set 99: subscribes it where
+# the set is subscribed and merges it, or drops it if nothing was added yet
+def finish_merge(module, node_conninfos, cluster_name, set_id, origin_id, receiver_id, subscribe, empty):
+    if empty:
+        statements = ["drop set (id=%s, origin=%s);" % (TEMP_SET_ID, origin_id)]
+    else:
+        statements = []
+        if subscribe:
+            statements.append("subscribe set(id=%s, provider=%s, receiver=%s);" % (TEMP_SET_ID, origin_id, receiver_id))
+        statements.append("merge set(id=%s, add id=%s, origin=%s);" % (set_id, TEMP_SET_ID, origin_id))
+
+    cmd = slonik_script(cluster_name, node_conninfos, statements)
+    return run_slonik(module, cmd)
+
+# Dropping a table from the set and subscribing it again through a temporary
+# set makes slon truncate and copy it on the receiver, the rest of the set
+# is left alone
+def resync_tables(module, master_conninfo, slave_conninfo, cluster_name, set_id, origin_id, receiver_id, resynced_tables):
+    statements = ["set drop table (origin=%s, id=%s);" % (origin_id, table['id']) for table in resynced_tables]
+    statements.extend(merge_statements(set_id, origin_id, origin_id, receiver_id, resynced_tables, []))
+
+    cmd = slonik_script(cluster_name,
+                        [(origin_id, master_conninfo), (receiver_id, slave_conninfo)],
+                        statements)
+    return run_slonik(module, cmd)
 
 # ===========================================
 # Module execution.
@@ -135,6 +169,7 @@ def main():
             cluster_name    = dict(default="replication"),
             replication_user= dict(default="postgres"),
             password        = dict(default=""),
+            agent_socket    = dict(default="~/.ansible/slony_agent.sock"),
             master_db       = dict(required=True),
             master_host     = dict(required=True),
             slave_db        = dict(required=True),
@@ -143,14 +178,21 @@ def main():
             origin_id       = dict(required=True),
             receiver_id     = dict(required=True),
             tables          = dict(required=True, type='list'),
-            sequences       = dict(required=False, type='list'),
+            sequences       = dict(default=[], type='list'),
+            resync          = dict(default=[], type='list'),
+            force_resync    = dict(default=False, type='bool'),
+            max_lag_events  = dict(default=None, type='int'),
+            max_lag_seconds = dict(default=None, type='int'),
+            lag_timeout     = dict(default=600, type='int'),
+            lock_timeout    = dict(default=300, type='int'),
+            lock_host       = dict(default=None),
+            lock_db         = dict(default=None),
+            slonik_retries  = dict(default=5, type='int'),
+            slonik_retry_delay = dict(default=1, type='float'),
         ),
         supports_check_mode = False
     )
 
-    if not postgresqldb_found:
-        module.fail_json(msg="the python psycopg2 module is required")
-
     port             = module.params["port"]
     cluster_name     = module.params["cluster_name"]
     replication_user = module.params["replication_user"]
@@ -164,28 +206,20 @@ def main():
     receiver_id      = module.params["receiver_id"]
     tables           = module.params["tables"]
     sequences        = module.params["sequences"]
+    resync           = module.params["resync"]
+    force_resync     = module.params["force_resync"]
 
     changed          = False
 
-    master_conninfo  = "host=%s dbname=%s user=%s port=%s password=%s" % (master_host, master_db, replication_user, port, password)
-    slave_conninfo   = "host=%s dbname=%s user=%s port=%s password=%s" % (slave_host, slave_db, replication_user, port, password)
-
-    # To use defaults values, keyword arguments must be absent, so
-    # check which values are empty and don't include in the **kw
-    # dictionary
-    params_map = {
-        "password":"password",
-        "port":"port"
-    }
+    if resync and not force_resync:
+        module.fail_json(msg="resync recopies tables %s on every run, set force_resync=yes to do it" % resync)
 
-    kw = dict( (params_map[k], v) for (k, v) in module.params.iteritems()
-              if k in params_map and v != '' )
+    master_conninfo  = build_conninfo(master_host, master_db, replication_user, port, password)
+    slave_conninfo   = build_conninfo(slave_host, slave_db, replication_user, port, password)
 
     try:
-        # TODO: this probably gets overwritten by contents of kw which can lead
-        # to a total poopshow
-        db_connection_master = psycopg2.connect(master_conninfo)
-        master_cursor        = db_connection_master.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        db_connection_master = connect(module, master_conninfo)
+        master_cursor        = dict_cursor(db_connection_master)
 
     except Exception, e:
         module.fail_json(msg="unable to connect to database: %s" % e)
@@ -195,8 +229,8 @@ def main():
     # set merge scenario. In other cases, we can ignore this connection failing
     # to be established.
     try:
-        db_connection_slave  = psycopg2.connect(slave_conninfo)
-        slave_cursor         = db_connection_slave.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        db_connection_slave  = connect(module, slave_conninfo)
+        slave_cursor         = dict_cursor(db_connection_slave)
         slave_reachable = True
     except Exception, e:
         slave_reachable = False
@@ -204,19 +238,91 @@ def main():
 
 
 
+    lock_cursor = cluster_lock_cursor(module, master_cursor, cluster_name,
+                                      [(origin_id, master_host, master_db), (receiver_id, slave_host, slave_db)])
+    lock_cluster(module, lock_cursor, cluster_name)
+
+    arg_table_ids = frozenset(map(lambda x: x['id'], tables))
+    arg_sequence_ids = frozenset(map(lambda x: x['id'], sequences))
+
+    result = {}
+    result['changed'] = False
+
+    #
+    # Finish a merge or resync an earlier run left halfway in set 99
+    #
+    resumed_ids = frozenset()
+    temp_origin = set_origin(master_cursor, cluster_name, TEMP_SET_ID)
+    if temp_origin is not None:
+        leftover_tables = replicated_tables(master_cursor, cluster_name, TEMP_SET_ID)
+        leftover_sequences = replicated_sequences(master_cursor, cluster_name, TEMP_SET_ID)
+        subscribers = set_subscribers(master_cursor, cluster_name, set_id)
+        temp_subscribers = set_subscribers(master_cursor, cluster_name, TEMP_SET_ID)
+        finish_by_hand = ("finish it with 'merge set (id=<set>, add id=%s, origin=<origin>);' or "
+                          "'drop set (id=%s, origin=<origin>);' in slonik and run again" % (TEMP_SET_ID, TEMP_SET_ID))
+        foreign_ids = ((frozenset(t['tab_id'] for t in leftover_tables) - arg_table_ids)
+                       | (frozenset(q['seq_id'] for q in leftover_sequences) - arg_sequence_ids))
+        if temp_origin != int(origin_id) or foreign_ids:
+            module.fail_json(msg="set %s is left over from an earlier merge and holds more than tables and sequences of set %s, %s"
+                             % (TEMP_SET_ID, set_id, finish_by_hand))
+        if subscribers not in ([], [int(receiver_id)]) or temp_subscribers not in ([], subscribers):
+            module.fail_json(msg="set %s is left over from an earlier merge, subscribed by nodes %s while set %s is subscribed by nodes %s, %s"
+                             % (TEMP_SET_ID, temp_subscribers, set_id, subscribers, finish_by_hand))
+        if subscribers and not slave_reachable:
+            module.fail_json(msg="Cannot finish merging set %s if the slave is unreachable" % TEMP_SET_ID)
+
+        if subscribers:
+            wait_for_lag(module, master_cursor, cluster_name, [receiver_id])
+            node_conninfos = [(origin_id, master_conninfo), (receiver_id, slave_conninfo)]
+        else:
+            node_conninfos = [(origin_id, master_conninfo)]
+        empty = not leftover_tables and not leftover_sequences
+        (rc, out, err) = finish_merge(module, node_conninfos, cluster_name, set_id, origin_id, receiver_id,
+                                      bool(subscribers) and not temp_subscribers, empty)
+        if rc != 0:
+            fail_slonik(module, rc, out, err)
+
+        result['changed'] = True
+        resumed_ids = frozenset(t['tab_id'] for t in leftover_tables)
+        result['resumed'] = sorted(resumed_ids)
+
     present_tables = replicated_tables(master_cursor, cluster_name, set_id)
     present_sequences = replicated_sequences(master_cursor, cluster_name, set_id)
 
     present_table_ids = frozenset(map(lambda x: x[0], present_tables))
     present_sequence_ids = frozenset(map(lambda x: x[0], present_sequences))
 
-    # print tables
+    #
+    # Recopy the tables asked for before anything else changes the set
+    #
+    # tables merged back above were just copied again, which is what a rerun
+    # of a failed resync asks for
+    resync_ids = frozenset(int(tid) for tid in resync) - resumed_ids
+    if resync_ids:
+        unknown_ids = resync_ids - frozenset(t['tab_id'] for t in present_tables)
+        if unknown_ids:
+            module.fail_json(msg="tables %s are not in set %s, can't resync them" % (sorted(unknown_ids), set_id))
+
+        subscribers = set_subscribers(master_cursor, cluster_name, set_id)
+        if subscribers != [int(receiver_id)]:
+            module.fail_json(msg="set %s is subscribed by nodes %s, resync only works for a set with receiver %s as its one subscriber"
+                             % (set_id, subscribers, receiver_id))
+        if not slave_reachable:
+            module.fail_json(msg="Cannot resync tables if the slave is unreachable")
+
+        wait_for_lag(module, master_cursor, cluster_name, [receiver_id])
 
-    arg_table_ids = frozenset(map(lambda x: x['id'], tables))
-    arg_sequence_ids = frozenset(map(lambda x: x['id'], sequences))
+        resynced_tables = [{'id': t['tab_id'],
+                            'fqname': "%s.%s" % (t['tab_nspname'], t['tab_relname']),
+                            'comment': t['tab_comment'] or '',
+                            'key': t['tab_idxname']}
+                           for t in present_tables if t['tab_id'] in resync_ids]
+        (rc, out, err) = resync_tables(module, master_conninfo, slave_conninfo, cluster_name, set_id, origin_id, receiver_id, resynced_tables)
+        if rc != 0:
+            fail_slonik(module, rc, out, err)
 
-    result = {}
-    result['changed'] = False
+        result['changed'] = True
+        result['resynced'] = sorted(resync_ids)
 
     #
     # Take care of removing tables from replication set that are no longer in the config
@@ -229,14 +335,14 @@ def main():
             (rc, out, err) = drop_table(module, master_host, master_db, replication_user, cluster_name, password, port, origin_id, tid)
             result['changed'] = True
             if rc != 0:
-                module.fail_json(stdout=out,msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
 
     # drop no longer replicated sequences from the set
     for sid in sequence_ids_to_remove:
             (rc, out, err) = drop_sequence(module, master_host, master_db, replication_user, cluster_name, password, port, origin_id, sid)
             result['changed'] = True
             if rc != 0:
-                module.fail_json(stdout=out,msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
 
     #
     # Take care of adding new tables to the replication set
@@ -255,6 +361,8 @@ def main():
         if not slave_reachable:
             module.fail_json(msg="Cannot merge sets if the slave is unreachable")
 
+        wait_for_lag(module, master_cursor, cluster_name, [receiver_id])
+
         #
         # merge into existing subscription
         #
@@ -263,7 +371,7 @@ def main():
 
         (rc, out, err) = merge_tables_seqs(module, master_conninfo, slave_conninfo, cluster_name, set_id, origin_id, origin_id, receiver_id, new_tables, new_sequences)
         if rc != 0:
-            module.fail_json(stdout=out, msg=err, rc=rc)
+            fail_slonik(module, rc, out, err)
 
         result['changed'] = True
 
@@ -283,11 +391,9 @@ def main():
                     port,
                     set_id,
                     origin_id,
-                    table['id'],
-                    table['fqname'],
-                    table.setdefault('comment', ''))
+                    table)
             if rc != 0:
-                module.fail_json(stdout=out, msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
         for sid in new_sequence_ids:
             sequence = next(s for s in sequences if s['id'] == sid)
             (rc, out, err) = create_sequence(
@@ -304,7 +410,7 @@ def main():
                     sequence['fqname'],
                     sequence.setdefault('comment', ''))
             if rc != 0:
-                module.fail_json(stdout=out, msg=err, rc=rc)
+                fail_slonik(module, rc, out, err)
 
         result['changed'] = True
 
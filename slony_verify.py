@@ -0,0 +1,424 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+DOCUMENTATION = '''
+---
+module: slony_verify
+author: Alexandr Kurilin
+version_added: "1.9"
+short_description: Compare replicated table contents between origin and a subscriber
+requirements: [psycopg2]
+description:
+    - Splits every table of a replication set into ranges of chunk_size rows
+      along the table's replication key, hashes each range on the origin and
+      the receiver and reports the ranges that differ
+    - Chunk boundaries are found by walking the key index chunk_size rows at
+      a time, and chunks are compared by a pool of parallelism workers, each
+      with its own pair of connections, so chunk_size and parallelism are
+      what to turn down on a busy node
+    - A comparison only counts when both hashes are of the same SYNC
+      position. Per table, the origin reads its latest SYNC and checks that
+      no change to the table has committed since, and all of the table's
+      chunks are then hashed in that one exported snapshot. The receiver is
+      hashed when it has applied exactly that SYNC. Anything else is
+      inconclusive.
+    - Rows are hashed as the origin's column list, with the same time zone,
+      date and float output settings on both nodes, so differing server
+      defaults or column order don't show up as differences
+    - Differing and inconclusive chunks are compared again up to rechecks
+      times, each round once the origin has a newer SYNC. Chunks that never
+      got a conclusive comparison, as can happen on a table written to all
+      the time, are reported under inconclusive rather than as differences.
+'''
+
+EXAMPLES = '''
+- slony_verify: master_host=db1 slave_host=db2 master_db=app slave_db=app set_id=1 origin_id=1 chunk_size=50000 parallelism=4
+'''
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from ansible.module_utils.slony.common import build_conninfo, replicated_tables, require_psycopg2
+
+# ===========================================
+# Postgres / slony support methods.
+#
+
+def quote_ident(name):
+    return '"%s"' % name.replace('"', '""')
+
+# Settings the text form of a row depends on, set alike on both nodes
+SESSION_SETTINGS = [
+    ("TimeZone", "UTC"),
+    ("DateStyle", "ISO, YMD"),
+    ("IntervalStyle", "postgres"),
+    ("extra_float_digits", "3"),
+    ("bytea_output", "hex"),
+]
+
+def table_columns(cursor, relation):
+    query = """SELECT attname FROM pg_catalog.pg_attribute
+               WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+               ORDER BY attnum"""
+    cursor.execute(query, (relation,))
+    return [r[0] for r in cursor.fetchall()]
+
+# Columns of the unique index slony replicates the table by, in index order
+def key_columns(cursor, nspname, idxname):
+    query = """SELECT a.attname
+               FROM pg_catalog.pg_index i
+               CROSS JOIN generate_series(0, i.indnatts - 1) AS k
+               JOIN pg_catalog.pg_attribute a ON a.attrelid = i.indrelid
+                                              AND a.attnum = i.indkey[k]
+               WHERE i.indexrelid = %s::regclass
+               ORDER BY k"""
+    cursor.execute(query, ("%s.%s" % (quote_ident(nspname), quote_ident(idxname)),))
+    return [r[0] for r in cursor.fetchall()]
+
+# WHERE clause and arguments for the keys after lower up to and including
+# upper, either of which may be open
+def key_range(keys, lower, upper):
+    key_list = ", ".join(keys)
+    conditions = []
+    args = []
+    if lower is not None:
+        conditions.append("(%s) > (%s)" % (key_list, ", ".join(["%s"] * len(keys))))
+        args.extend(lower)
+    if upper is not None:
+        conditions.append("(%s) <= (%s)" % (key_list, ", ".join(["%s"] * len(keys))))
+        args.extend(upper)
+    if conditions:
+        return ("WHERE " + " AND ".join(conditions), args)
+    return ("", args)
+
+# Every chunk_size-th key, in key order. Consecutive boundaries delimit the
+# chunks, with open ends before the first and after the last one. Each step
+# is an index range scan of chunk_size keys in a transaction of its own,
+# rather than one sort of the whole table.
+def chunk_boundaries(cursor, relation, keys, chunk_size):
+    key_list = ", ".join(keys)
+    boundaries = []
+    lower = None
+    while True:
+        (where, args) = key_range(keys, lower, None)
+        query = """SELECT {0} FROM {1} {2}
+                   ORDER BY {0}
+                   OFFSET %s LIMIT 1""".format(key_list, relation, where)
+        cursor.execute(query, args + [int(chunk_size) - 1])
+        row = cursor.fetchone()
+        cursor.connection.rollback()
+        if row is None:
+            return boundaries
+        lower = tuple(row)
+        boundaries.append(lower)
+
+def chunk_hash(cursor, relation, keys, columns, lower, upper):
+    key_list = ", ".join(keys)
+    (where, args) = key_range(keys, lower, upper)
+    query = """SELECT count(*), md5(string_agg(md5(ROW({3})::text), '' ORDER BY {0}))
+               FROM {1} {2}""".format(key_list, relation, where, ", ".join(columns))
+    cursor.execute(query, args)
+    return tuple(cursor.fetchone())
+
+def last_sync(cursor, cluster_name, origin_id):
+    query = """SELECT coalesce(max(ev_seqno), 0) FROM _{0}.sl_event
+               WHERE ev_origin = %s AND ev_type = 'SYNC'""".format(cluster_name)
+    cursor.execute(query, (int(origin_id),))
+    return int(cursor.fetchone()[0])
+
+# The origin's latest SYNC and the snapshot it was taken in
+def last_sync_snapshot(cursor, cluster_name, origin_id):
+    query = """SELECT ev_seqno, ev_snapshot::text FROM _{0}.sl_event
+               WHERE ev_origin = %s AND ev_type = 'SYNC'
+               ORDER BY ev_seqno DESC LIMIT 1""".format(cluster_name)
+    cursor.execute(query, (int(origin_id),))
+    row = cursor.fetchone()
+    if row is None:
+        return (0, None)
+    return (int(row[0]), row[1])
+
+# Whether the snapshot we're in sees changes to the table that the SYNC
+# taken in snapshot doesn't cover, i.e. log rows from transactions that
+# weren't yet committed then. Transactions from before the SYNC's xmin are
+# all covered, which keeps this to a range scan of the (log_origin,
+# log_txid) index.
+def changed_since_sync(cursor, cluster_name, origin_id, tab_id, snapshot):
+    if snapshot is None:
+        return True
+    query = """SELECT EXISTS (
+                 SELECT 1 FROM _{0}.sl_log_1
+                 WHERE log_origin = %(origin)s AND log_tableid = %(table)s
+                   AND log_txid >= pg_catalog.txid_snapshot_xmin(%(snapshot)s::txid_snapshot)
+                   AND NOT pg_catalog.txid_visible_in_snapshot(log_txid, %(snapshot)s::txid_snapshot)
+                 UNION ALL
+                 SELECT 1 FROM _{0}.sl_log_2
+                 WHERE log_origin = %(origin)s AND log_tableid = %(table)s
+                   AND log_txid >= pg_catalog.txid_snapshot_xmin(%(snapshot)s::txid_snapshot)
+                   AND NOT pg_catalog.txid_visible_in_snapshot(log_txid, %(snapshot)s::txid_snapshot)
+               )""".format(cluster_name)
+    cursor.execute(query, {'origin': int(origin_id), 'table': int(tab_id), 'snapshot': snapshot})
+    return cursor.fetchone()[0]
+
+# The receiver's hash as of the given SYNC. Events are stored in the
+# receiver's sl_event in the same transaction that applies them, so the
+# position read in the hash's snapshot is the one hashed. The hash is None
+# when the receiver has already moved past that SYNC, or hasn't reached it
+# within the timeout.
+def receiver_chunk(connection, cluster_name, origin_id, relation, keys, columns, lower, upper, seqno, timeout):
+    deadline = time.time() + timeout
+    while True:
+        cursor = connection.cursor()
+        try:
+            applied = last_sync(cursor, cluster_name, origin_id)
+            if applied == seqno:
+                return (applied, chunk_hash(cursor, relation, keys, columns, lower, upper))
+            if applied > seqno:
+                return (applied, None)
+        finally:
+            connection.rollback()
+        if time.time() > deadline:
+            return (applied, None)
+        time.sleep(1)
+
+class Verifier(object):
+
+    def __init__(self, psycopg2, master_conninfo, slave_conninfo, cluster_name, origin_id, chunk_size, sync_timeout, rechecks):
+        self.psycopg2 = psycopg2
+        self.master_conninfo = master_conninfo
+        self.slave_conninfo = slave_conninfo
+        self.cluster_name = cluster_name
+        self.origin_id = origin_id
+        self.chunk_size = chunk_size
+        self.sync_timeout = sync_timeout
+        self.rechecks = rechecks
+        self.local = threading.local()
+        self.exporter = None
+        self.connections = []
+        self.lock = threading.Lock()
+
+    # one pair of connections per worker thread
+    def connection_pair(self):
+        if not hasattr(self.local, 'master'):
+            self.local.master = self.connect(self.master_conninfo)
+            self.local.slave = self.connect(self.slave_conninfo)
+        return (self.local.master, self.local.slave)
+
+    def connect(self, conninfo):
+        connection = self.psycopg2.connect(conninfo)
+        cursor = connection.cursor()
+        for (name, value) in SESSION_SETTINGS:
+            cursor.execute("SELECT pg_catalog.set_config(%s, %s, false)", (name, value))
+        connection.commit()
+        connection.set_isolation_level(self.psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+    def plan_table(self, table):
+        (master, slave) = self.connection_pair()
+        try:
+            cursor = master.cursor()
+            keys = [quote_ident(k) for k in key_columns(cursor, table['tab_nspname'], table['tab_idxname'])]
+            relation = "%s.%s" % (quote_ident(table['tab_nspname']), quote_ident(table['tab_relname']))
+            columns = [quote_ident(c) for c in table_columns(cursor, relation)]
+            boundaries = chunk_boundaries(cursor, relation, keys, self.chunk_size)
+        finally:
+            master.rollback()
+        edges = [None] + boundaries + [None]
+        return {'tab_id': table['tab_id'], 'relation': relation, 'keys': keys, 'columns': columns,
+                'chunks': [(edges[i], edges[i + 1]) for i in range(len(edges) - 1)]}
+
+    # Opens the origin snapshot all of a table's chunks are hashed in, on a
+    # connection of its own that holds it until release_snapshot. The
+    # snapshot id is None when the table changed after the latest SYNC.
+    def table_snapshot(self, plan):
+        if self.exporter is None:
+            self.exporter = self.connect(self.master_conninfo)
+        cursor = self.exporter.cursor()
+        (seqno, snapshot) = last_sync_snapshot(cursor, self.cluster_name, self.origin_id)
+        if changed_since_sync(cursor, self.cluster_name, self.origin_id, plan['tab_id'], snapshot):
+            self.exporter.rollback()
+            return (seqno, None)
+        cursor.execute("SELECT pg_catalog.pg_export_snapshot()")
+        return (seqno, cursor.fetchone()[0])
+
+    def release_snapshot(self):
+        self.exporter.rollback()
+
+    # Waits, up to sync_timeout, for the origin to move past seqno, so that
+    # a recheck doesn't just repeat the comparison that failed
+    def wait_for_sync(self, seqno):
+        cursor = self.exporter.cursor()
+        deadline = time.time() + self.sync_timeout
+        delay = 0.5
+        while time.time() < deadline:
+            (latest, snapshot) = last_sync_snapshot(cursor, self.cluster_name, self.origin_id)
+            self.exporter.rollback()
+            if latest > seqno:
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+
+    # The receiver's seqno and both hashes of one chunk, a hash being None
+    # when that side couldn't be hashed at the SYNC
+    def compare_chunk(self, job):
+        (plan, (lower, upper), seqno, snapshot_id) = job
+        (master, slave) = self.connection_pair()
+        cursor = master.cursor()
+        try:
+            cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
+            origin_digest = chunk_hash(cursor, plan['relation'], plan['keys'], plan['columns'], lower, upper)
+        finally:
+            master.rollback()
+        (applied, receiver_digest) = receiver_chunk(slave, self.cluster_name, self.origin_id, plan['relation'], plan['keys'],
+                                                    plan['columns'], lower, upper, seqno, self.sync_timeout)
+        return (applied, origin_digest, receiver_digest)
+
+    # Compares every chunk of the planned tables, a table at a time with its
+    # chunks spread over the pool, and the chunks that didn't match again in
+    # up to rechecks more rounds. Returns an outcome for every chunk that
+    # never matched.
+    def compare(self, pool, plans):
+        pending = [(plan, chunk) for plan in plans for chunk in plan['chunks']]
+        outcomes = {}
+        seqno = None
+        for attempt in range(self.rechecks + 1):
+            if not pending:
+                break
+            if seqno is not None:
+                self.wait_for_sync(seqno)
+            unmatched = []
+            for plan in plans:
+                chunks = [chunk for (p, chunk) in pending if p is plan]
+                if not chunks:
+                    continue
+                (seqno, snapshot_id) = self.table_snapshot(plan)
+                try:
+                    if snapshot_id is None:
+                        compared = [(None, None, None)] * len(chunks)
+                    else:
+                        compared = pool.map(self.compare_chunk, [(plan, chunk, seqno, snapshot_id) for chunk in chunks])
+                finally:
+                    self.release_snapshot()
+                for (chunk, (applied, origin_digest, receiver_digest)) in zip(chunks, compared):
+                    key = (plan['tab_id'], chunk)
+                    if origin_digest is not None and origin_digest == receiver_digest:
+                        outcomes.pop(key, None)
+                        continue
+                    outcome = outcomes.setdefault(key, {
+                        'table_id': plan['tab_id'],
+                        'table': plan['relation'],
+                        'lower': chunk[0] and [str(v) for v in chunk[0]],
+                        'upper': chunk[1] and [str(v) for v in chunk[1]],
+                        'status': 'inconclusive',
+                    })
+                    outcome['sync_seqno'] = seqno
+                    outcome['receiver_seqno'] = applied
+                    # a mismatch seen at one SYNC position stays a difference
+                    if origin_digest is not None and receiver_digest is not None:
+                        outcome['status'] = 'different'
+                        outcome['origin_rows'] = origin_digest[0]
+                        outcome['receiver_rows'] = receiver_digest[0]
+                    unmatched.append((plan, chunk))
+            pending = unmatched
+        return outcomes.values()
+
+# ===========================================
+# Module execution.
+#
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            port=dict(default="5432"),
+            cluster_name=dict(default="replication"),
+            replication_user=dict(default="postgres"),
+            password=dict(default=""),
+            master_db=dict(required=True),
+            master_host=dict(required=True),
+            slave_db=dict(required=True),
+            slave_host=dict(required=True),
+            set_id=dict(required=True),
+            origin_id=dict(required=True),
+            table_ids=dict(default=None, type='list'),
+            chunk_size=dict(default=10000, type='int'),
+            parallelism=dict(default=2, type='int'),
+            sync_timeout=dict(default=300, type='int'),
+            rechecks=dict(default=2, type='int'),
+            fail_on_difference=dict(default=True, type='bool'),
+        ),
+        supports_check_mode = True
+    )
+
+    # the chunk comparisons need REPEATABLE READ snapshots of their own, so
+    # this module always connects directly rather than through the agent
+    psycopg2 = require_psycopg2(module)
+
+    port = module.params["port"]
+    cluster_name = module.params["cluster_name"]
+    replication_user = module.params["replication_user"]
+    password = module.params["password"]
+    master_db = module.params["master_db"]
+    master_host = module.params["master_host"]
+    slave_db = module.params["slave_db"]
+    slave_host = module.params["slave_host"]
+    set_id = module.params["set_id"]
+    origin_id = module.params["origin_id"]
+    table_ids = module.params["table_ids"]
+    chunk_size = module.params["chunk_size"]
+    parallelism = module.params["parallelism"]
+    sync_timeout = module.params["sync_timeout"]
+    rechecks = module.params["rechecks"]
+    fail_on_difference = module.params["fail_on_difference"]
+
+    master_conninfo = build_conninfo(master_host, master_db, replication_user, port, password)
+    slave_conninfo = build_conninfo(slave_host, slave_db, replication_user, port, password)
+
+    if chunk_size < 1 or parallelism < 1:
+        module.fail_json(msg="chunk_size and parallelism must be at least 1")
+
+    try:
+        db_connection_master = psycopg2.connect(master_conninfo)
+        master_cursor = db_connection_master.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    except Exception, e:
+        module.fail_json(msg="unable to connect to database: %s" % e)
+
+    tables = replicated_tables(master_cursor, cluster_name, set_id)
+    db_connection_master.close()
+    if table_ids is not None:
+        wanted = frozenset(int(t) for t in table_ids)
+        tables = [t for t in tables if t['tab_id'] in wanted]
+
+    verifier = Verifier(psycopg2, master_conninfo, slave_conninfo, cluster_name, origin_id, chunk_size, sync_timeout, rechecks)
+    pool = ThreadPool(parallelism)
+    try:
+        plans = pool.map(verifier.plan_table, tables)
+        outcomes = verifier.compare(pool, plans)
+    except Exception, e:
+        module.fail_json(msg="verification failed: %s" % e)
+    finally:
+        pool.close()
+        pool.join()
+        verifier.close()
+
+    result = {}
+    result['changed'] = False
+    result['tables'] = len(tables)
+    result['chunks'] = sum(len(plan['chunks']) for plan in plans)
+    outcomes.sort(key=lambda o: (o['table_id'], o['lower']))
+    result['differences'] = [o for o in outcomes if o['status'] == 'different']
+    result['inconclusive'] = [o for o in outcomes if o['status'] == 'inconclusive']
+    differences = result['differences']
+
+    if fail_on_difference and differences:
+        module.fail_json(msg="%s of %s chunks differ between origin and receiver" % (len(differences), result['chunks']), **result)
+
+    module.exit_json(**result)
+
+from ansible.module_utils.basic import *
+main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# Tests for the omit copy pre-seed check in module_utils/slony/preseed.py.
+#
+# Run from the repository root with: python -m unittest discover tests
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "module_utils"))
+
+from slony.preseed import relation_estimates, verify_preseeded
+
+
+# Answers queries from a fake catalog: pg_class lookups by name find the
+# given tables, and sl_table holds nothing, as on a node that hasn't
+# subscribed to the set yet
+class CatalogCursor(object):
+
+    def __init__(self, relations):
+        self.relations = relations
+        self.rows = []
+
+    def execute(self, query, args=None):
+        if "sl_table" in query:
+            self.rows = []
+            return
+        (nspnames, relnames) = args
+        self.rows = [(n, r, self.relations[(n, r)]) for (n, r) in zip(nspnames, relnames)
+                     if (n, r) in self.relations]
+
+    def fetchall(self):
+        return self.rows
+
+
+class PreseedTest(unittest.TestCase):
+
+    provider = {("public", "accounts"): 1000, ("public", "orders"): 50000}
+
+    def test_receiver_without_sl_table_rows(self):
+        cursor = CatalogCursor({("public", "accounts"): 1010, ("public", "orders"): 49000})
+        receiver = relation_estimates(cursor, self.provider.keys())
+        self.assertEqual(verify_preseeded(self.provider, receiver, 10), [])
+
+    def test_missing_table(self):
+        cursor = CatalogCursor({("public", "accounts"): 1000})
+        receiver = relation_estimates(cursor, self.provider.keys())
+        self.assertEqual(verify_preseeded(self.provider, receiver, 10),
+                         ["public.orders is missing on the receiver"])
+
+    def test_unanalyzed_table(self):
+        receiver = {("public", "accounts"): -1, ("public", "orders"): 50000}
+        self.assertEqual(verify_preseeded(self.provider, receiver, 10),
+                         ["public.accounts has no statistics on the receiver, ANALYZE it first"])
+
+    def test_row_count_drift(self):
+        receiver = {("public", "accounts"): 1000, ("public", "orders"): 20000}
+        self.assertEqual(verify_preseeded(self.provider, receiver, 10),
+                         ["public.orders has ~50000 rows on the provider but ~20000 on the receiver"])
+
+
+if __name__ == "__main__":
+    unittest.main()
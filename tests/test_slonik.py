@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# Tests for the slonik output classification in module_utils/slony/slonik.py.
+#
+# Run from the repository root with: python -m unittest discover tests
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "module_utils"))
+
+from slony.slonik import (ALREADY_ABSENT, ALREADY_PRESENT, classify_slonik, retryable,
+                          slonik_error, slonik_script, statement_lines)
+
+CONNINFO = "host=db1 dbname=app user=postgres port=5432 password="
+
+
+class ClassifySlonikTest(unittest.TestCase):
+
+    def test_success(self):
+        self.assertEqual(classify_slonik(0, "", ""), "ok")
+
+    def test_already_absent(self):
+        err = "<stdin>:3: PGRES_FATAL_ERROR select \"_replication\".dropSet(99);  - ERROR:  Slony-I: dropSet(): set 99 not found\n"
+        self.assertEqual(classify_slonik(255, "", err, ALREADY_ABSENT), "done")
+
+    def test_already_present(self):
+        err = "<stdin>:3: PGRES_FATAL_ERROR select \"_replication\".setAddTable(1, 3, ...);  - ERROR:  Slony-I: setAddTable_int(): table id 3 has already been assigned!\n"
+        self.assertEqual(classify_slonik(255, "", err, ALREADY_PRESENT), "done")
+
+    def test_existing_cluster_schema_is_present(self):
+        err = "<stdin>:3: Error: namespace \"_replication\" already exists in database of node 1\n"
+        self.assertEqual(classify_slonik(255, "", err, ALREADY_PRESENT), "done")
+
+    def test_missing_slonik_is_fatal(self):
+        err = "sh: 1: slonik: command not found\n"
+        self.assertEqual(classify_slonik(127, "", err, ALREADY_ABSENT), "fatal")
+
+    def test_missing_database_is_fatal(self):
+        err = "<stdin>:3: FATAL:  database \"app\" does not exist\n"
+        self.assertEqual(classify_slonik(255, "", err, ALREADY_ABSENT), "fatal")
+
+    def test_lock_contention_is_transient(self):
+        err = "<stdin>:3: PGRES_FATAL_ERROR lock table \"_replication\".sl_config_lock;  - ERROR:  canceling statement due to lock timeout\n"
+        self.assertEqual(classify_slonik(255, "", err), "transient")
+
+    def test_restarting_node_is_transient(self):
+        err = "<stdin>:3: FATAL:  the database system is starting up\n"
+        self.assertEqual(classify_slonik(255, "", err), "transient")
+
+    def test_progress_lines_are_not_transient(self):
+        out = "<stdin>:4: waiting for event (1,5000000012) to be confirmed on node 2\n"
+        err = "<stdin>:5: PGRES_FATAL_ERROR select \"_replication\".subscribeSet(1, 1, 2, 't', 'f');  - ERROR:  Slony-I: subscribeSet(): set 1 not found\n"
+        self.assertEqual(classify_slonik(255, out, err), "fatal")
+
+    def test_done_pattern_only_applies_when_given(self):
+        err = "<stdin>:3: PGRES_FATAL_ERROR select \"_replication\".dropSet(99);  - ERROR:  Slony-I: dropSet(): set 99 not found\n"
+        self.assertEqual(classify_slonik(255, "", err), "fatal")
+
+
+class SlonikErrorTest(unittest.TestCase):
+
+    def test_picks_error_line(self):
+        err = "<stdin>:4: NOTICE:  something\n<stdin>:5: PGRES_FATAL_ERROR ... - ERROR:  boom\n"
+        self.assertEqual(slonik_error("", err), "<stdin>:5: PGRES_FATAL_ERROR ... - ERROR:  boom")
+
+    def test_falls_back_to_script_line(self):
+        err = "<stdin>:4: could not connect to server: Connection refused\ncheck the host\n"
+        self.assertEqual(slonik_error("", err), "<stdin>:4: could not connect to server: Connection refused")
+
+    def test_no_output(self):
+        self.assertEqual(slonik_error("", ""), "slonik failed without any output")
+
+
+class RetryableTest(unittest.TestCase):
+
+    def script(self, statements):
+        return slonik_script("replication", [(1, CONNINFO), (2, CONNINFO)], statements)
+
+    def test_statement_lines_skip_preamble(self):
+        self.assertEqual(statement_lines(self.script(["create set (id=1, origin=1);", "drop set (id=1, origin=1);"])), [4, 5])
+
+    def test_single_statement(self):
+        cmd = self.script(["create set (id=1, origin=1);"])
+        self.assertTrue(retryable(cmd, "", "sh: 1: slonik: killed\n"))
+
+    def test_failed_on_first_statement(self):
+        cmd = self.script(["create set (id=1, origin=1);", "drop set (id=1, origin=1);"])
+        self.assertTrue(retryable(cmd, "", "<stdin>:4: FATAL:  the database system is starting up\n"))
+
+    def test_failed_on_later_statement(self):
+        cmd = self.script(["create set (id=1, origin=1);", "drop set (id=1, origin=1);"])
+        self.assertFalse(retryable(cmd, "", "<stdin>:5: FATAL:  the database system is starting up\n"))
+
+    def test_failed_without_line(self):
+        cmd = self.script(["create set (id=1, origin=1);", "drop set (id=1, origin=1);"])
+        self.assertFalse(retryable(cmd, "", "server closed the connection unexpectedly\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()